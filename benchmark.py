@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# benchmarks of the hot paths of conll2praat, on a synthetic corpus
+# prerequisite : pympi.Praat, python-magic
+#
+# usage : python benchmark.py [--sentences N] [--tiers N] [--repeat N]
+#             [--only GROUP,GROUP,..] [--json results.json]
+#             [--compare previous.json]
+#
+# the results (best wall time of the runs, in seconds) are written in JSON
+# with --json, to be compared with those of another commit with --compare
+
+from exporter_lib import *
+from make_corpus import make_corpus
+import exporter
+import random, tempfile, subprocess, platform
+
+groups = [
+    'distance', 'pairing', 'parsing', 'writing', 'cache', 'encoding',
+    'alignment', 'end_to_end'
+]
+
+# name of the benchmark -> best wall time in seconds
+results = collections.OrderedDict()
+
+
+# best wall time of repeat runs of fun(), each one with an empty memo of
+# distances
+def time_it(fun, repeat=3):
+    best = None
+    result = None
+    for k in range(repeat):
+        distance_memo.clear()
+        t0 = time.time()
+        result = fun()
+        t = time.time() - t0
+        if best is None or t < best:
+            best = t
+    return best, result
+
+
+def record(name, t, ref=None):
+    results[name] = t
+    info_print('\t{:32s} {:9.4f}s{}'.format(
+        name, t, ' (x{:.1f})'.format(results[ref] / t) if ref else ''))
+
+
+def tiers_of(tg):
+    return [(t.name, t.tier_type, t.xmin, t.xmax, t.intervals)
+            for t in tg.tiers]
+
+
+# distance engines, on random pairs of strings of the length of sentences
+def bench_distance(repeat, num_pairs=50, seed=0):
+    rnd = random.Random(seed)
+    alphabet = u'abcdeéilmnorstu '
+    pairs = []
+    for k in range(num_pairs):
+        n = rnd.randint(20, 200)
+        s1 = u''.join(rnd.choice(alphabet) for i in range(n))
+        s2 = u''.join(rnd.choice(alphabet) for i in range(2 * n))
+        pairs.append((s1, s2))
+    info_print('edit distance of {} pairs'.format(num_pairs))
+    for name, engine in distance_engines.items():
+        t, _ = time_it(lambda: [engine(s1, s2) for s1, s2 in pairs], repeat)
+        record('distance.{}'.format(name), t, ref='distance.reference')
+    t, _ = time_it(lambda: [semiglobal_distances(s1, s2) for s1, s2 in pairs],
+                   repeat)
+    record('distance.semiglobal', t)
+
+
+# pairing of the names of CoNLL and TextGrid files : make_paires() vs
+# one_to_many_pairing() on each name
+def bench_pairing(repeat, num_files=300):
+    conll_files = ['corpus_{:05d}.conll'.format(k) for k in range(num_files)]
+    tg_files = ['Corpus_{:05d}.TextGrid'.format(k) for k in range(num_files)]
+
+    def reference():
+        pairs = []
+        for f1 in conll_files:
+            f2 = one_to_many_pairing(f1, tg_files)
+            if f2 and f1 == one_to_many_pairing(f2, conll_files):
+                pairs.append((f1, f2))
+        return pairs
+
+    info_print('pairing of {} files'.format(num_files))
+    t_ref, pairs_ref = time_it(reference, 1)
+    record('pairing.reference', t_ref)
+    t, pairs = time_it(lambda: make_paires(conll_files, tg_files), repeat)
+    record('pairing', t, ref='pairing.reference')
+    if pairs != pairs_ref:
+        err_print('pairings disagree')
+
+
+# TextGridPlus.from_file in each format, vs the reader of pympi
+def bench_parsing(paths, repeat):
+    info_print('parsing of {}'.format(os.path.basename(paths['binary'][0])))
+    for fmt in ['text', 'short', 'binary', 'collection']:
+        path = paths[fmt][0]
+        codec = get_encoding(path)
+        t, tg = time_it(lambda: TextGridPlus(path, codec=codec), repeat)
+        if fmt != 'collection':  # (not supported by pympi)
+            t_ref, tg_ref = time_it(
+                lambda: pympi.Praat.TextGrid(path, codec=codec), repeat)
+            record('parsing.{}.pympi'.format(fmt), t_ref)
+            if tiers_of(tg_ref) != tiers_of(tg):
+                err_print('parsers disagree ({})'.format(fmt))
+        record('parsing.{}'.format(fmt),
+               t,
+               ref='parsing.{}.pympi'.format(fmt)
+               if fmt != 'collection' else None)
+
+
+# binary writing of a TextGrid read from a binary file, with a new tier :
+# pympi vs TextGridPlus (unchanged tiers copied)
+def bench_writing(paths, repeat):
+    tmpdir = tempfile.mkdtemp()
+    tg = TextGridPlus(paths['binary'][0], codec='binary')
+    new = tg.add_tier('tx_new')
+    for x1, x2, text in tg.get_tier('tx').get_intervals():
+        new.add_interval(x1, x2, text)
+
+    out_ref = os.path.join(tmpdir, 'bench_ref.TextGrid')
+    out_plus = os.path.join(tmpdir, 'bench_plus.TextGrid')
+    info_print('binary writing')
+    t_ref, _ = time_it(
+        lambda: pympi.Praat.TextGrid.to_file(tg, out_ref, mode='binary'),
+        repeat)
+    record('writing.pympi', t_ref)
+    t, _ = time_it(lambda: tg.to_file(out_plus, mode='binary'), repeat)
+    record('writing', t, ref='writing.pympi')
+    if open(out_ref, 'rb').read() != open(out_plus, 'rb').read():
+        err_print('binary writers disagree')
+
+
+# cold parsing vs warm load from the cache of parsed TextGrids
+def bench_cache(paths, repeat):
+    tg_path = paths['binary'][0]
+    cache = TextGridCache(os.path.join(tempfile.mkdtemp(), 'cache'))
+    cache.get(tg_path, 'binary')
+    info_print('cache of parsed TextGrids')
+    t_cold, tg_cold = time_it(lambda: TextGridPlus(tg_path, codec='binary'),
+                              repeat)
+    record('cache.cold', t_cold)
+    t_warm, tg_warm = time_it(lambda: cache.get(tg_path, 'binary'), repeat)
+    record('cache.warm', t_warm, ref='cache.cold')
+    if tiers_of(tg_cold) != tiers_of(tg_warm):
+        err_print('cached TextGrid differs')
+
+
+# encoding detection of a long text TextGrid : cold (libmagic on a prefix)
+# and cached
+def bench_encoding(paths, repeat):
+    tg_path = paths['text'][0]
+
+    def cold():
+        encoding_cache.clear()
+        return get_encoding(tg_path)
+
+    info_print('encoding detection of {} bytes'.format(
+        os.path.getsize(tg_path)))
+    t_cold, enc = time_it(cold, repeat)
+    record('encoding.cold', t_cold)
+    t_hot, enc_hot = time_it(lambda: get_encoding(tg_path), repeat)
+    record('encoding.cached', t_hot, ref='encoding.cold')
+    if enc != enc_hot:
+        err_print('cached encoding differs')
+
+
+# findTimes (sentence by sentence local search), core_routine,
+# core_routine_global and detect_ref_tier of the exporter
+def bench_alignment(paths, repeat):
+    tg = TextGridPlus(paths['binary'][0], codec='binary')
+    sents = list(read_conll_sentences(paths['conll'][0]))
+    ref = tg.get_tier('mot')
+    info_print('alignment of {} sentences on {} intervals'.format(
+        len(sents), len(ref)))
+
+    def local_search():
+        index = RefTierIndex(ref)
+        cursor = 0
+        for sent in sents:
+            begin, end, cursor_out, dist = findTimes(sent.tokens,
+                                                     index,
+                                                     lowerbound=cursor,
+                                                     upperbound=cursor + 50)
+            cursor = max(cursor, cursor_out)
+
+    def new_dest():
+        return ColumnarTier(tg.xmin, tg.xmax, 'tx_new', 'IntervalTier')
+
+    t, _ = time_it(local_search, repeat)
+    record('alignment.findTimes', t)
+    t, _ = time_it(
+        lambda: exporter.core_routine(sents, 2, '#', new_dest(), ref),
+        repeat)
+    record('alignment.core_routine', t)
+    t, _ = time_it(
+        lambda: exporter.core_routine_global(sents, 2, '#', new_dest(), ref),
+        repeat)
+    record('alignment.core_routine_global', t)
+    t, _ = time_it(
+        lambda: exporter.detect_ref_tier(
+            tg, sents, 2, '#', 'tx_new', [t.name for t in tg.tiers]), repeat)
+    record('alignment.detect_ref_tier', t)
+
+
+# run of exporter.py on the folders of the corpus, in a new process
+def bench_end_to_end(folder, repeat):
+    info_print('exporter.py on {}'.format(folder))
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'exporter.py')
+    for fmt, options in [('binary', []), ('text', []),
+                         ('binary', ['--prenucleus'])]:
+        out = tempfile.mkdtemp()
+        command = [
+            sys.executable, script,
+            os.path.join(folder, 'conll'),
+            os.path.join(folder, fmt), out
+        ] + options
+        t, _ = time_it(
+            lambda: subprocess.run(command,
+                                   stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL,
+                                   check=True), repeat)
+        record('end_to_end.{}{}'.format(fmt, ''.join(options)), t)
+
+
+# commit, platform and parameters of the run
+def run_metadata(args):
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL).stdout.decode('ascii').strip()
+    except Exception as e:
+        commit = None
+    return collections.OrderedDict([
+        ('commit', commit),
+        ('date', time.strftime('%Y-%m-%d %H:%M:%S')),
+        ('python', platform.python_version()),
+        ('numpy', numpy_installed),
+        ('args', vars(args)),
+    ])
+
+
+# ratio of the times of a previous run to those of this run
+def compare(previous_path):
+    with open(previous_path) as f:
+        previous = json.load(f)
+    info_print('comparison with {} (commit {})'.format(
+        previous_path, previous['meta'].get('commit')))
+    for name, t in results.items():
+        if name in previous['results']:
+            t_prev = previous['results'][name]
+            info_print('\t{:32s} {:9.4f}s -> {:9.4f}s (x{:.2f})'.format(
+                name, t_prev, t, t_prev / t if t else float('inf')))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='conll2praat benchmarks')
+    parser.add_argument('--sentences',
+                        type=int,
+                        default=2000,
+                        help='number of sentences of the synthetic corpus')
+    parser.add_argument('--tiers',
+                        type=int,
+                        default=4,
+                        help='number of tiers of the synthetic TextGrids')
+    parser.add_argument('--noise',
+                        type=float,
+                        default=0.05,
+                        help='orthographic noise of the synthetic CoNLL')
+    parser.add_argument('--reorder',
+                        type=float,
+                        default=0.01,
+                        help='ratio of sentences swapped in the CoNLL')
+    parser.add_argument('--sound-bytes',
+                        type=int,
+                        default=10000000,
+                        help='size of the Sound object of the Collection')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=3,
+                        help='number of runs, the best one is kept')
+    parser.add_argument('--only',
+                        default=','.join(groups),
+                        help='benchmarks to run among {} (default: all)'.
+                        format(', '.join(groups)))
+    parser.add_argument('--json', help='file to write the results in')
+    parser.add_argument('--compare',
+                        help='results of a previous run to compare with')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    paths = make_corpus(folder,
+                        num_files=1,
+                        num_sentences=args.sentences,
+                        num_tiers=args.tiers,
+                        noise=args.noise,
+                        reorder=args.reorder,
+                        sound_bytes=args.sound_bytes)
+    only = args.only.split(',')
+    if 'distance' in only:
+        bench_distance(args.repeat)
+    if 'pairing' in only:
+        bench_pairing(args.repeat)
+    if 'parsing' in only:
+        bench_parsing(paths, args.repeat)
+    if 'writing' in only:
+        bench_writing(paths, args.repeat)
+    if 'cache' in only:
+        bench_cache(paths, args.repeat)
+    if 'encoding' in only:
+        bench_encoding(paths, args.repeat)
+    if 'alignment' in only:
+        bench_alignment(paths, args.repeat)
+    if 'end_to_end' in only:
+        bench_end_to_end(folder, args.repeat)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'meta': run_metadata(args),
+                'results': results
+            }, f, indent=2)
+    if args.compare:
+        compare(args.compare)
@@ -9,127 +9,241 @@
 #     Luigi Liu
 
 from exporter_lib import *
+from identify_prenucleus import add_prenucleus_tiers
 
 
-def core_routine(conll, srcCol, pauseSign, dest, ref, num_sent_to_read=-1):
+def core_routine(sents,
+                 srcCol,
+                 pauseSign,
+                 dest,
+                 ref,
+                 num_sent_to_read=-1,
+                 max_dist=-1):
     # initialization
-    tokens = []
     sentId = 0
-    pauseId = 0
     cursor = 0
     err_num = 0
     dist_tot = 0
+    # index the ref. tier once for all the sentences
+    if not isinstance(ref, RefTierIndex):
+        ref = RefTierIndex(ref)
+    # the intervals are added to the dest. tier at the end, at once
+    builder = TierBuilder(dest)
 
     # boucle de lecture
-    for n, row in enumerate(conll):
+    for conll_sent in sents:
+        n = conll_sent.end_line
+        tokens = conll_sent.tokens
+        sent = ' '.join(tokens)
+        deb_print("L{} sentence no.{} '{}'", n, sentId, sent)
+        metrics.count('sentences')
+
+        # try a local search from cursor to end of time with by default thld.
+        [begin, end, cursor_out,
+         best_dist] = findTimes(tokens,
+                                ref,
+                                lowerbound=cursor,
+                                upperbound=cursor + 50,
+                                thld=0.10,
+                                pauseSign=pauseSign)
+        if cursor_out >= cursor:
+            cursor = cursor_out
+            deb_print("L{} local (begin,end) = ({:8.3f},{:8.3f})", n, begin,
+                      end)
+
+            # écrire le contenu dans le tier de destination
+            builder.add_interval(begin, end, sent, line=n)
 
-        # les métadonnées
-        if row and len(row) < 10:
-            metadata = row[0]
-            continue
-
-    # token dans une phrase
-        if row:
-            token = row[srcCol - 1]
-            # récolte des tokens
-            if token.strip() != pauseSign:
-                tokens.append(token)
+        else:
+            # try a global search but with a more strict threshold for distance
+            # on the positions short-listed by the q-gram index of the ref. tier
+            metrics.count('global_fallbacks')
+            [begin, end, cursor_out,
+             best_dist] = ref.get_qgram_index().search(tokens,
+                                                       thld=0.05,
+                                                       pauseSign=pauseSign)
+            if cursor_out >= 0:
+                # écrire le contenu dans le tier de destination
+                builder.add_interval(begin, end, sent, line=n)
+                deb_print("Line {} global (begin,end) = ({:8.3f},{:8.3f})", n,
+                          begin, end)
             else:
-                pauseId += 1
+                err_print("Search fails @ Line {} of the CoNLL".format(n))
+                metrics.count('failed_sentences')
+                err_num += 1
 
-    # saute de ligne à la frontière des phrases
-        else:
-            sent = ' '.join(tokens)
-            deb_print("L{} sentence no.{} '{}'".format(n, sentId, sent))
+        # early break if number of sentences to read is reached
+        if sentId > num_sent_to_read and num_sent_to_read > 0: break
 
-            # try a local search from cursor to end of time with by default thld.
-            [begin, end, cursor_out,
-             best_dist] = findTimes(tokens,
-                                    ref,
-                                    lowerbound=cursor,
-                                    upperbound=cursor + 50,
-                                    thld=0.10,
-                                    pauseSign=pauseSign)
-            if cursor_out >= cursor:
-                cursor = cursor_out
-                deb_print("L{} local (begin,end) = ({:8.3f},{:8.3f})".format(
-                    n, begin, end))
+        # préparation à la prochaine phrase
+        dist_tot += best_dist
+        sentId += 1
 
-                # écrire le contenu dans le tier de destination
-                try:
-                    dest.add_interval(begin=begin,
-                                      end=end,
-                                      value=sent,
-                                      check=True)
-                except Exception as e:
-                    err_print(u"Line {} @ CoNLL : {}".format(n, e))
-                    err_num += 1
+        # early abandon once the accumulated distance exceeds max_dist
+        if dist_tot > max_dist and max_dist >= 0: break
 
-            else:
-                # try a global search but with a more strict threshold for distance
-                [begin, end, cursor_out,
-                 best_dist] = findTimes(tokens,
-                                        ref,
-                                        lowerbound=0,
-                                        upperbound=-1,
-                                        thld=0.05,
-                                        pauseSign=pauseSign)
-                if cursor_out >= 0:
-                    # écrire le contenu dans le tier de destination
-                    try:
-                        dest.add_interval(begin=begin,
-                                          end=end,
-                                          value=sent,
-                                          check=True)
-                        deb_print(
-                            "Line {} global (begin,end) = ({:8.3f},{:8.3f})".
-                            format(n, begin, end))
-                    except Exception as e:
-                        err_print(u"Line {} @ CoNLL : {}".format(n, e))
-                        err_num += 1
-                else:
-                    err_print("Search fails @ Line {} of the CoNLL".format(n))
-                    err_num += 1
+    # overlaps are checked in one pass
+    for line, e in builder.commit():
+        err_print(u"Line {} @ CoNLL : {}".format(line, e))
+        metrics.count('conflicts')
+        err_num += 1
+
+    if ref.qgram_index is not None:
+        info_print(ref.qgram_index.summary())
+    return err_num, dist_tot
+
+
+# alternative to core_routine : align the whole token stream of the CoNLL
+# file against the ref. tier in one banded DP pass, then derive the time
+# limits of each sentence from its first and last aligned tokens
+def core_routine_global(sents,
+                        srcCol,
+                        pauseSign,
+                        dest,
+                        ref,
+                        num_sent_to_read=-1,
+                        band=100,
+                        thld=0.10):
+    # initialization
+    err_num = 0
+    dist_tot = 0
+    if not isinstance(ref, RefTierIndex):
+        ref = RefTierIndex(ref)
+
+    # sentences of the CoNLL file : (line number, tokens)
+    sents = [(conll_sent.end_line, conll_sent.tokens) for conll_sent in sents]
+    if num_sent_to_read > 0:
+        sents = sents[:num_sent_to_read + 1]
+
+    # token streams without pauses and tokens made of macrosyntax signs
+    conll_tokens = []
+    conll_sent_ids = []
+    for sentId, (n, tokens) in enumerate(sents):
+        for token in tokens:
+            token = normalize(token)
+            if token:
+                conll_tokens.append(token)
+                conll_sent_ids.append(sentId)
+    ref_pos = [
+        k for k, token in enumerate(ref.tokens)
+        if token.strip() != pauseSign and ref.window_text(k, 1)
+    ]
+    ref_tokens = [ref.window_text(k, 1) for k in ref_pos]
+
+    matches, cost = align_tokens_banded(conll_tokens, ref_tokens, band=band)
+    deb_print('global alignment of {} tokens on {} tokens, cost {}',
+              len(conll_tokens), len(ref_tokens), cost)
+    if cost == float('inf'):
+        # no path within the band : every sentence is reported as failed
+        warning_print('a band of {} tokens cannot align {} tokens on {} tokens',
+                      band, len(conll_tokens), len(ref_tokens))
+
+    # first and last aligned ref. intervals of each sentence
+    first = [-1] * len(sents)
+    last = [-1] * len(sents)
+    for sentId, match in zip(conll_sent_ids, matches):
+        if match >= 0:
+            if first[sentId] < 0:
+                first[sentId] = ref_pos[match]
+            last[sentId] = ref_pos[match]
+
+    builder = TierBuilder(dest)
+    for sentId, (n, tokens) in enumerate(sents):
+        sent = ' '.join(tokens)
+        deb_print("L{} sentence no.{} '{}'", n, sentId, sent)
+        metrics.count('sentences')
+        if first[sentId] < 0:
+            err_print("Search fails @ Line {} of the CoNLL".format(n))
+            metrics.count('failed_sentences')
+            err_num += 1
+            continue
+
+        # verify the distance as findTimes does
+        sent_norm = normalize(sent)
+        dist = distance_normalized(
+            sent_norm,
+            ref.window_text(first[sentId], last[sentId] - first[sentId] + 1))
+        metrics.count('distance_lookups')
+        dist_tot += dist
+        if dist > thld * (len(sent)**1.1):
+            err_print("Search fails @ Line {} of the CoNLL".format(n))
+            metrics.count('failed_sentences')
+            err_num += 1
+            continue
 
-            # early break if number of sentences to read is reached
-            if sentId > num_sent_to_read and num_sent_to_read > 0: break
+        begin = ref.begins[first[sentId]]
+        end = ref.ends[last[sentId]]
+        deb_print("L{} global (begin,end) = ({:8.3f},{:8.3f})", n, begin, end)
+        # écrire le contenu dans le tier de destination
+        builder.add_interval(begin, end, sent, line=n)
 
-            # préparation à la prochaine phrase
-            dist_tot += best_dist
-            sentId += 1
-            tokens = []
+    # overlaps are checked in one pass
+    for line, e in builder.commit():
+        err_print(u"Line {} @ CoNLL : {}".format(line, e))
+        metrics.count('conflicts')
+        err_num += 1
 
     return err_num, dist_tot
 
 
 def core_routine_with_known_ref_tier(tg,
-                                     conll_path,
+                                     sents,
                                      srcCol,
                                      pauseSign,
                                      destTierName,
                                      valideRefTierName,
-                                     num_sent_to_read=-1):
-    # read the ref. tier
-    refTier = tg.get_tier(valideRefTierName)
+                                     num_sent_to_read=-1,
+                                     align='greedy',
+                                     band=100,
+                                     refIndex=None):
+    # read the ref. tier (or its prebuilt index)
+    refTier = refIndex if refIndex is not None else tg.get_tier(
+        valideRefTierName)
     # initilize the dest. tier
     tg.remove_tier(destTierName)
     destTier = tg.add_tier(destTierName)
-    # export the transcription from conll file
-    with open(conll_path, 'r') as f:
-        conllReader = csv.reader(f, delimiter='\t', quotechar='\\')
-        err_num, dist = core_routine(conllReader, srcCol, pauseSign, destTier,
+    # export the transcription from the sentences of the conll file
+    if align == 'global':
+        err_num, dist = core_routine_global(sents, srcCol, pauseSign,
+                                            destTier, refTier,
+                                            num_sent_to_read, band)
+    else:
+        err_num, dist = core_routine(sents, srcCol, pauseSign, destTier,
                                      refTier, num_sent_to_read)
     # return error indicators
     return err_num, dist
 
 
+# score of a candidate time reference tier : accumulated edit distance of the
+# first sentences, abandoned as soon as it exceeds max_dist
+def score_ref_tier(tier, sents, srcCol, pauseSign, num_sent_to_read,
+                   max_dist=-1):
+    dest = pympi.Praat.Tier(tier.xmin,
+                            tier.xmax,
+                            name='score',
+                            tier_type='IntervalTier')
+    return core_routine(sents, srcCol, pauseSign, dest, tier, num_sent_to_read,
+                        max_dist)
+
+
+# score_ref_tier() in a worker of a process pool, with the counters and the
+# distance memo statistics of the worker to add to those of the parent
+def score_ref_tier_in_worker(*args):
+    metrics.reset()
+    memo_start = distance_memo.stats()
+    result = score_ref_tier(*args)
+    return (result, metrics.stage_entry('other')['counters'],
+            distance_memo.stats_since(memo_start))
+
+
 def detect_ref_tier(tg,
-                    conll_path,
+                    sents,
                     srcCol,
                     pauseSign,
                     destTierName,
                     avaliableTierNames,
-                    num_sent_to_read=10):
+                    num_sent_to_read=10,
+                    pool=None):
     warning_print(
         'Registered time reference tiers do not exist in TextGrid, launch auto-detection !'
     )
@@ -137,21 +251,369 @@ def detect_ref_tier(tg,
     err_by_tier = collections.Counter()
     dist_by_tier = collections.Counter()
 
-    # try all tier as time referece tiers one by one
-    for tierName in avaliableTierNames:
-        info_print(u'try {}'.format(tierName))
-        # try 10 sentences for each tier and collect their accumulated edit distance
-        err_by_tier[tierName],dist_by_tier[tierName] = \
-                core_routine_with_known_ref_tier(tg,conll_path,srcCol,pauseSign,destTierName,tierName, num_sent_to_read)
+    # sentences to try and their tokens
+    sents_to_try = sents[:num_sent_to_read + 2]
+    sampled_tokens = [
+        token for conll_sent in sents[:num_sent_to_read]
+        for token in conll_sent.tokens
+    ]
+    num_tokens = sum(1 for conll_sent in sents
+                     for token in conll_sent.tokens if normalize(token))
+
+    # eliminate the obviously wrong tiers
+    candidates = prefilter_ref_tiers(tg, avaliableTierNames, sampled_tokens,
+                                     num_tokens, pauseSign)
+    if not candidates:
+        warning_print('No tier passes the prefilter, try them all')
+        candidates = avaliableTierNames
+    info_print(u'candidate(s) : {}'.format(', '.join(candidates)))
+
+    # score the most likely tier first, its distance is then used to abandon
+    # the others early, which are scored in the process pool of the run if
+    # any and if there are several of them (a pool costs more than the
+    # scoring of one tier)
+    tierName = candidates[0]
+    err_by_tier[tierName], dist_by_tier[tierName] = score_ref_tier(
+        tg.get_tier(tierName), sents_to_try, srcCol, pauseSign,
+        num_sent_to_read)
+    others = candidates[1:]
+    if pool is not None and len(others) > 1:
+        futures = [
+            pool.submit(score_ref_tier_in_worker, tg.get_tier(tierName),
+                        sents_to_try, srcCol, pauseSign, num_sent_to_read,
+                        dist_by_tier[candidates[0]]) for tierName in others
+        ]
+        for tierName, future in zip(others, futures):
+            (err_by_tier[tierName], dist_by_tier[tierName]), counters, \
+                    memo_stats = future.result()
+            metrics.add_counters(counters)
+            distance_memo.add_stats(memo_stats)
+    else:
+        for tierName in others:
+            err_by_tier[tierName], dist_by_tier[tierName] = score_ref_tier(
+                tg.get_tier(tierName), sents_to_try, srcCol, pauseSign,
+                num_sent_to_read, dist_by_tier[candidates[0]])
 
-    # remove the detination generated during trail
-    tg.remove_tier(destTierName)
+    # keep the order of the tiers in the TextGrid to break ties as before
+    dist_by_tier = collections.Counter(
+        collections.OrderedDict((tierName, dist_by_tier[tierName])
+                                for tierName in avaliableTierNames
+                                if tierName in dist_by_tier))
 
     # use the best one to make final exporting
     best_ref_name, best_dist = dist_by_tier.most_common()[-1]
     return best_ref_name, best_dist
 
 
+# the inputs of a pair, read by read_pair()
+class PairInputs(object):
+    __slots__ = ('enc', 'tg', 'origin', 'warm_entry', 'tg_key', 'conll_key',
+                 'sents', 'error', 'metrics')
+
+    def __init__(self):
+        self.enc = self.tg = self.origin = self.warm_entry = None
+        self.tg_key = self.conll_key = None
+        self.sents = self.error = None
+        self.metrics = Metrics()
+
+
+# first stages of process_pair(), which wait on the disk : detection of the
+# encoding, parsing of the TextGrid and reading of the CoNLL file. They print
+# nothing and are timed in the metrics of the inputs, so they can run ahead
+# in a thread (see process_pairs_pipelined())
+def read_pair(conll_path,
+              inTg_path,
+              srcCol=2,
+              pauseSign='#',
+              cache=None,
+              warm=None):
+    inputs = PairInputs()
+    m = inputs.metrics
+    # detection of textgrid file encoding:utf-8, ascii, etc
+    with m.stage('encoding'):
+        inputs.enc = get_encoding(inTg_path)
+
+    with m.stage('parsing'):
+        try:
+            # (the size and mtime of the TextGrid read)
+            inputs.tg_key = encoding_cache_key(inTg_path)
+            # the TextGrid kept in memory by a long-running exporter
+            if warm is not None:
+                inputs.warm_entry = warm.get(inTg_path, inputs.tg_key)
+            if inputs.warm_entry:
+                inputs.tg = inputs.warm_entry.tg
+                inputs.origin = 'in memory'
+                m.count('warm_hits')
+            else:
+                if cache:
+                    inputs.tg, hit = cache.lookup(inTg_path, inputs.enc,
+                                                  javaobj_installed)
+                    if hit:
+                        inputs.origin = 'cached'
+                        m.count('cache_hits')
+                else:
+                    inputs.tg = TextGridPlus(file_path=inTg_path,
+                                             codec=inputs.enc,
+                                             analorFileEn=javaobj_installed)
+                if warm is not None:
+                    inputs.warm_entry = warm.put(inTg_path, inputs.tg_key,
+                                                 inputs.tg)
+        except Exception as e:
+            inputs.error = e
+            return inputs
+
+    with m.stage('reading'):
+        # (the size and mtime of the CoNLL file read, which the ref. tier
+        # detected for the TextGrid in memory depends on)
+        inputs.conll_key = encoding_cache_key(conll_path)
+        # the CoNLL file is parsed once for all the passes
+        inputs.sents = list(
+            read_conll_sentences(conll_path, srcCol, pauseSign))
+    return inputs
+
+
+# next stages of process_pair() on the inputs of a pair, timed in the global
+# metrics : ref. tier detection, alignment and prenuclei. return the number
+# of errors (None if the TextGrid could not be read) and the ref. tier
+def align_pair(inputs,
+               conll_path,
+               inTg_path,
+               outputTg_path,
+               refTierNames,
+               destTierName='tx_new',
+               pauseSign='#',
+               srcCol=2,
+               align='greedy',
+               band=100,
+               pool=None,
+               prenucleus=False):
+    metrics.reset()
+    metrics.stages.update(inputs.metrics.stages)
+    info_print('\t{:s} {:s}'.format('<-', conll_path))
+    info_print('\t{:s} {:s} [{}]'.format('<-', inTg_path,
+                                         inputs.enc if inputs.enc else
+                                         'unknown'))
+    info_print('\t{:s} {:s} [{}]'.format('->', outputTg_path, 'binary'))
+    if inputs.error is not None:
+        err_print('TextGridPlus constructor fails : {}'.format(inputs.error))
+        return None, None
+    if inputs.origin:
+        info_print('\t{:s} {:s} [{}]'.format('<-', inTg_path, inputs.origin))
+    tg = inputs.tg
+    sents = inputs.sents
+    warm_entry = inputs.warm_entry
+
+    # handel diff. reference tier names
+    avaliableTierNames = [t.name for t in tg.get_tiers()]
+    valideRefTierNames = list(set(avaliableTierNames) & set(refTierNames))
+    # make exportaiton if a ref. tier is listed in registered in refTierNames
+    if valideRefTierNames:
+        best_ref_name = valideRefTierNames[0]
+    # or the one detected before for the TextGrid in memory
+    elif warm_entry and warm_entry.ref_name(conll_path, inputs.conll_key):
+        best_ref_name = warm_entry.ref_name(conll_path, inputs.conll_key)
+        info_print('Use \'{}\' as time reference tier (detected before)'.
+                   format(best_ref_name))
+    # ortherwise lauche ref. tier detection
+    else:
+        with metrics.stage('detection'):
+            best_ref_name, best_dist = detect_ref_tier(tg,
+                                                       sents,
+                                                       srcCol,
+                                                       pauseSign,
+                                                       destTierName,
+                                                       avaliableTierNames,
+                                                       num_sent_to_read=10,
+                                                       pool=pool)
+        info_print('Set \'{}\' as time reference tier'.format(best_ref_name))
+        if warm_entry:
+            warm_entry.set_ref_name(conll_path, inputs.conll_key,
+                                    best_ref_name)
+    with metrics.stage('alignment'):
+        # the index of the ref. tier serves the prenucleus stage too
+        if warm_entry:
+            ref_index = warm_entry.ref_index(best_ref_name)
+        else:
+            ref_index = RefTierIndex(tg.get_tier(best_ref_name))
+        err_num, dist = core_routine_with_known_ref_tier(
+            tg, sents, srcCol, pauseSign, destTierName, best_ref_name,
+            align=align, band=band, refIndex=ref_index)
+
+    # identify_prenucleus.py on the TextGrid in memory
+    if prenucleus:
+        with metrics.stage('prenucleus'):
+            add_prenucleus_tiers(tg, ref_index, destTierName)
+    return err_num, best_ref_name
+
+
+# last stage of process_pair()
+def write_pair(tg, outputTg_path, cache=None):
+    # remark: dy default, export TextGrid object in binaray format
+    tg.to_file(outputTg_path, mode='binary', codec='utf-8')
+    # the output is parsed again by identify_prenucleus.py
+    if cache:
+        cache.store(tg, outputTg_path, 'binary', javaobj_installed)
+
+
+# export the transcription of one (CoNLL, TextGrid) pair into a new TextGrid
+# return the number of errors, the encoding of the input TextGrid, the
+# metrics of the stages (see Metrics.report()) and the ref. tier
+def process_pair(conll_path,
+                 inTg_path,
+                 outputTg_path,
+                 refTierNames,
+                 destTierName='tx_new',
+                 pauseSign='#',
+                 srcCol=2,
+                 align='greedy',
+                 band=100,
+                 pool=None,
+                 cache=None,
+                 prenucleus=False,
+                 warm=None):
+    inputs = read_pair(conll_path, inTg_path, srcCol, pauseSign, cache, warm)
+    err_num, best_ref_name = align_pair(inputs, conll_path, inTg_path,
+                                        outputTg_path, refTierNames,
+                                        destTierName, pauseSign, srcCol,
+                                        align, band, pool, prenucleus)
+    if err_num is None:
+        return None, inputs.enc, metrics.report(), None
+    with metrics.stage('writing'):
+        write_pair(inputs.tg, outputTg_path, cache)
+    info_print("DONE.\n")
+    return err_num, inputs.enc, metrics.report(), best_ref_name
+
+
+# process_pair() on tasks (index, arguments of process_pair()) as a pipeline
+# of bounded stages : a pool of read_ahead threads reads the inputs of the
+# next pairs while a pair is aligned in this thread, and another thread
+# writes the outputs. At most read_ahead pairs are read ahead and
+# read_ahead outputs wait for their writing, which bounds the memory in use.
+# (only this thread prints, the ref. tier detection being done from it, in
+# the process pool if any)
+# The readers do not use the TextGrids kept in memory, which two pairs with
+# the same TextGrid would then share : each TextGrid read is put in memory by
+# this thread, for the passes of the watch mode which follow.
+# yield the index and the result of each task, in order
+def process_pairs_pipelined(tasks,
+                            read_ahead=2,
+                            cache=None,
+                            prenucleus=False,
+                            warm=None,
+                            pool=None):
+    import concurrent.futures
+    tasks = iter(tasks)
+    reads = collections.deque()
+    writes = collections.deque()
+
+    # in the writing thread
+    def finish(result, tg, outputTg_path, pair_metrics):
+        err_num, enc, ref_name = result
+        if err_num is not None:
+            with pair_metrics.stage('writing'):
+                write_pair(tg, outputTg_path, cache)
+        return err_num, enc, pair_metrics.report(), ref_name
+
+    def written(k, task, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            err_print(u'{} : {}'.format(task[0], e))
+            return k, (None, None, {}, None)
+        if result[0] is not None:
+            info_print("DONE.\n")
+        return k, result
+
+    with concurrent.futures.ThreadPoolExecutor(read_ahead) as readers, \
+            concurrent.futures.ThreadPoolExecutor(1) as writer:
+
+        def read_next():
+            for k, task in tasks:
+                reads.append((k, task,
+                              readers.submit(read_pair, task[0], task[1],
+                                             task[6], task[5], cache)))
+                break
+
+        for n in range(read_ahead):
+            read_next()
+        while reads:
+            k, task, future = reads.popleft()
+            read_next()
+            try:
+                inputs = future.result()
+                if warm is not None and inputs.error is None:
+                    inputs.warm_entry = warm.put(task[1], inputs.tg_key,
+                                                 inputs.tg)
+                err_num, ref_name = align_pair(inputs,
+                                               *task,
+                                               pool=pool,
+                                               prenucleus=prenucleus)
+                # (the global metrics are reset for the next pair)
+                pair_metrics = Metrics()
+                pair_metrics.stages = metrics.stages
+                writes.append(
+                    (k, task,
+                     writer.submit(finish, (err_num, inputs.enc, ref_name),
+                                   inputs.tg, task[2], pair_metrics)))
+            except Exception as e:
+                err_print(u'{} : {}'.format(task[0], e))
+                failed = concurrent.futures.Future()
+                failed.set_result((None, None, {}, None))
+                writes.append((k, task, failed))
+            # backpressure : wait for the writings beyond read_ahead
+            while writes and (len(writes) > read_ahead or
+                              writes[0][2].done()):
+                yield written(*writes.popleft())
+        while writes:
+            yield written(*writes.popleft())
+
+
+# process_pair() for a worker of a process pool : the distance engine is set
+# in the worker and any exception is caught to be reported by the parent.
+# return the result of process_pair() and the distance memo statistics of
+# the worker for the pair
+def process_pair_in_worker(engine, *args, **kwargs):
+    set_distance_engine(engine)
+    memo_start = distance_memo.stats()
+    try:
+        result = process_pair(*args, **kwargs)
+    except Exception as e:
+        err_print(u'{} : {}'.format(args[0], e))
+        result = None, None, {}, None
+    return result, distance_memo.stats_since(memo_start)
+
+
+# requests of the spool folder of a long-running exporter : a file NAME.json
+# of the folder asks for the export of the pair of a CoNLL file, as
+# {"conll": "file.conll"}, its answer is written to done/NAME.json and the
+# request is removed
+def read_spool(spool):
+    requests = collections.defaultdict(list)
+    for name in sorted(os.listdir(spool)):
+        path = os.path.join(spool, name)
+        if not name.endswith('.json') or not os.path.isfile(path):
+            continue
+        submitted = os.path.getmtime(path)
+        try:
+            with open(path) as f:
+                request = json.load(f)
+            conll = os.path.basename(request['conll'])
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            answer_request(spool, name,
+                           {'error': 'invalid request : {}'.format(e)})
+            continue
+        requests[conll].append((name, request, submitted))
+    return requests
+
+
+def answer_request(spool, name, answer):
+    tmp_path = os.path.join(spool, 'done', name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(answer, f, indent=2)
+    os.replace(tmp_path, os.path.join(spool, 'done', name))
+    os.remove(os.path.join(spool, name))
+
+
 if __name__ == '__main__':
 
     # inform state for Analor file support
@@ -166,7 +628,72 @@ if __name__ == '__main__':
     parser.add_argument('conll_in', help='folder of conll files')
     parser.add_argument('praat_in', help='folder of input praat files')
     parser.add_argument('praat_out', help='folder for output praat files')
+    parser.add_argument('--engine',
+                        default='bitparallel',
+                        choices=list(distance_engines.keys()),
+                        help='edit distance engine (default: bitparallel)')
+    parser.add_argument(
+        '--align',
+        default='greedy',
+        choices=['greedy', 'global'],
+        help='greedy sentence by sentence search (default) or whole-file '
+        'banded alignment')
+    parser.add_argument('--band',
+                        type=int,
+                        default=100,
+                        help='half width in tokens of the band of the '
+                        'whole-file alignment (default: 100)')
+    parser.add_argument('--jobs',
+                        type=int,
+                        default=1,
+                        help='number of pairs of files processed in parallel '
+                        '(default: 1)')
+    parser.add_argument('--cache-dir',
+                        help='folder of a cache of the parsed TextGrids '
+                        '(default: no cache)')
+    parser.add_argument('--cache-size',
+                        type=int,
+                        default=1024,
+                        help='maximum size in MB of the cache (default: 1024)')
+    parser.add_argument('--prenucleus',
+                        action='store_true',
+                        help='identify the prenuclei as identify_prenucleus.py '
+                        'does, before writing the output files')
+    parser.add_argument('--force',
+                        action='store_true',
+                        help='process the pairs whose inputs are unchanged '
+                        'since the last run too')
+    parser.add_argument('--read-ahead',
+                        type=int,
+                        default=2,
+                        help='number of pairs read while a pair is aligned, '
+                        'which bounds the files in memory, 0 to process the '
+                        'pairs one after the other (default: 2)')
+    parser.add_argument('--distance-memo',
+                        type=int,
+                        default=1 << 14,
+                        help='number of distances kept in memory by kind, '
+                        'the least recently used ones being dropped '
+                        '(default: 16384)')
+    parser.add_argument('--watch',
+                        action='store_true',
+                        help='keep running after the first pass and export '
+                        'again each pair whose inputs change')
+    parser.add_argument('--poll',
+                        type=float,
+                        default=2.0,
+                        help='seconds between two scans of the input folders '
+                        'in watch mode (default: 2)')
+    parser.add_argument('--spool',
+                        help='folder of export requests in watch mode')
+    parser.add_argument('--warm-size',
+                        type=int,
+                        default=32,
+                        help='number of TextGrids kept in memory in watch '
+                        'mode (default: 32)')
     args = parser.parse_args()
+    set_distance_engine(args.engine)
+    distance_memo.resize(args.distance_memo)
     # make conll - praat pairs
 
     conllFolderPath,conllFiles = listfiles(args.conll_in)
@@ -179,6 +706,11 @@ if __name__ == '__main__':
     out_rep = args.praat_out
     if not os.path.exists(out_rep):
         os.makedirs(out_rep)
+    # encodings detected in the previous runs
+    set_encoding_cache(os.path.join(out_rep, '.encodings.json'))
+    tg_cache = None
+    if args.cache_dir:
+        tg_cache = TextGridCache(args.cache_dir, args.cache_size << 20)
     refTierNames = [
         'mot', 'MOT', 'TokensAlign'
     ]  # set refTierNames if you want an auto-deteciton by default
@@ -187,57 +719,262 @@ if __name__ == '__main__':
     srcCol = 2  # 'FORM' (CoNLL)
 
     # I/O handlers
+    run_wall, run_cpu = time.time(), time.process_time()
+    run_metrics = Metrics()
     err = collections.Counter()
     enc = collections.defaultdict()
-    conll_tg_pairs = conll_tg_pairs[::-1]
-    while conll_tg_pairs:
-        inconllFile, inTgfile = conll_tg_pairs.pop()
-        conll_path = os.path.join(conllFolderPath,inconllFile)
-        inTg_path = os.path.join(inputTgFolderPath,inTgfile)
-        info_print('\t{:s} {:s}'.format('<-', conll_path))
-        # detection of textgrid file encoding:utf-8, ascii, etc
-        enc[inTgfile] = get_encoding(inTg_path)
-        info_print('\t{:s} {:s} [{}]'.format(
-            '<-', inTg_path, enc[inTgfile] if enc[inTgfile] else 'unknown'))
+    timings = collections.defaultdict()
+    ref_tiers = {}
+    tasks = []
+    # pairs done in the previous runs, with the same options
+    manifest = Manifest(out_rep)
+    options = collections.OrderedDict([
+        ('version', tool_version()), ('ref_tiers', refTierNames),
+        ('dest_tier', destTierName), ('pause', pauseSign),
+        ('column', srcCol), ('align', args.align), ('band', args.band),
+        ('prenucleus', args.prenucleus)
+    ])
+    inputs = []
+    todo = []
+    # TextGrids kept in memory between the passes of the watch mode
+    warm = WarmTextGridCache(args.warm_size) if args.watch else None
+    # (the outputs of the two stages are named as by identify_prenucleus.py)
+    suffix = '_UPDATED_ADDED_PRENUCLEUS' if args.prenucleus else '_UPDATED'
+
+    def task_of(inconllFile, inTgfile):
+        conll_path = os.path.join(conllFolderPath, inconllFile)
+        inTg_path = os.path.join(inputTgFolderPath, inTgfile)
         outputTg_path = args.praat_out + '/' + insert_to_basename(
-            inTgfile, '_UPDATED', 'TextGrid')
-        info_print('\t{:s} {:s} [{}]'.format('->', outputTg_path, 'binary'))
-
-        try:
-            tg = TextGridPlus(file_path=inTg_path,
-                              codec=enc[inTgfile],
-                              analorFileEn=javaobj_installed)
-        except Exception as e:
-            err_print('TextGridPlus constructor fails : {}'.format(e))
-            continue
-
-        # handel diff. reference tier names
-        avaliableTierNames = [t.name for t in tg.get_tiers()]
-        valideRefTierNames = list(set(avaliableTierNames) & set(refTierNames))
-        # make exportaiton if a ref. tier is listed in registered in refTierNames
-        if valideRefTierNames:
-            err_num, dist = core_routine_with_known_ref_tier(
-                tg, conll_path, srcCol, pauseSign, destTierName,
-                valideRefTierNames[0])
-        # ortherwise lauche ref. tier detection
+            inTgfile, suffix, 'TextGrid')
+        return (conll_path, inTg_path, outputTg_path, refTierNames,
+                destTierName, pauseSign, srcCol, args.align, args.band)
+
+    for inconllFile, inTgfile in conll_tg_pairs:
+        tasks.append(task_of(inconllFile, inTgfile))
+        outputTg_path = tasks[-1][2]
+        inputs.append(manifest.inputs(*tasks[-1][:3]))
+        entry = manifest.done(outputTg_path, inputs[-1], options)
+        if entry and not args.force:
+            info_print('\t{:s} {:s} [{}]'.format('=', outputTg_path,
+                                                 'unchanged'))
+            err[inconllFile] = entry['errors']
+            enc[inTgfile] = entry['encoding']
+            if entry['ref_tier']:
+                ref_tiers[os.path.basename(outputTg_path)] = entry['ref_tier']
         else:
-            best_ref_name, best_dist = detect_ref_tier(tg,
-                                                       conll_path,
-                                                       srcCol,
-                                                       pauseSign,
-                                                       destTierName,
-                                                       avaliableTierNames,
-                                                       num_sent_to_read=10)
-            info_print(
-                'Set \'{}\' as time reference tier'.format(best_ref_name))
-            err_num, dist = core_routine_with_known_ref_tier(
-                tg, conll_path, srcCol, pauseSign, destTierName, best_ref_name)
-
-        err[inconllFile] = err_num
-        # remark: dy default, export TextGrid object in binaray format
-        tg.to_file(outputTg_path, mode='binary', codec='utf-8')
-        info_print("DONE.\n")
+            todo.append(len(tasks) - 1)
+
+    def collect(pair, task, task_inputs, result):
+        inconllFile, inTgfile = pair
+        err_num, enc[inTgfile], timings[inconllFile], ref_name = result
+        manifest.record(
+            collections.OrderedDict([('output', task[2]),
+                                     ('conll', task_inputs['conll']),
+                                     ('textgrid', task_inputs['textgrid']),
+                                     ('options', options),
+                                     ('ref_tier', ref_name),
+                                     ('errors', err_num),
+                                     ('encoding', enc[inTgfile])]))
+        if err_num is not None:
+            err[inconllFile] = err_num
+        # metrics of the file, next to the output
+        save_metrics(
+            metrics_path(out_rep, os.path.basename(task[2])),
+            collections.OrderedDict([('conll', task[0]), ('textgrid', task[1]),
+                                     ('output', task[2]),
+                                     ('errors', err_num),
+                                     ('stages', timings[inconllFile])]))
+        run_metrics.merge(timings[inconllFile])
+        # the ref. tier of each output, for identify_prenucleus.py
+        if ref_name:
+            ref_tiers[os.path.basename(task[2])] = ref_name
+        # (the encodings detected in workers are cached by the parent)
+        if enc[inTgfile]:
+            cache_encoding(os.path.join(inputTgFolderPath, inTgfile),
+                           enc[inTgfile])
+
+    # the candidate ref. tiers of a pair are scored in a pool of processes
+    # when the pairs themselves are processed one by one, i.e. with a
+    # single pair or in watch mode, the pool being kept for the whole run
+    detect_pool = None
+    if args.jobs > 1 and (len(todo) < 2 or args.watch):
+        import concurrent.futures
+        detect_pool = concurrent.futures.ProcessPoolExecutor(args.jobs)
+
+    if args.jobs > 1 and len(todo) > 1:
+        # process the pairs independently in a pool of processes, the ref.
+        # tier detection of each pair is then done serially in its worker
+        import concurrent.futures
+
+        def submit(executor, k):
+            return executor.submit(process_pair_in_worker,
+                                   args.engine,
+                                   *tasks[k],
+                                   cache=tg_cache,
+                                   prenucleus=args.prenucleus)
+
+        # result of a pair, the memo statistics of its worker being added
+        def result_of(future):
+            result, memo_stats = future.result()
+            distance_memo.add_stats(memo_stats)
+            return result
+
+        # process the pairs keys in a pool of jobs processes
+        # return the keys of the pairs lost in a crash of a worker
+        def run_pool(keys, jobs):
+            crashed = []
+            with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+                futures = [submit(executor, k) for k in keys]
+                for k, future in zip(keys, futures):
+                    try:
+                        result = result_of(future)
+                    except Exception as e:
+                        # a worker died, the pool is broken
+                        crashed.append(k)
+                        continue
+                    collect(conll_tg_pairs[k], tasks[k], inputs[k], result)
+            return crashed
+
+        crashed = run_pool(todo, args.jobs)
+        # the pairs lost are tried again in a new pool, then those lost again
+        # each in a pool of its own, so a pair which always crashes its
+        # worker fails alone
+        if crashed:
+            warning_print('{} pair(s) lost in a crash of a worker'.format(
+                len(crashed)))
+            crashed = run_pool(crashed, args.jobs)
+        for k in crashed:
+            if run_pool([k], 1):
+                err_print(u'{} : worker crashed'.format(tasks[k][0]))
+                collect(conll_tg_pairs[k], tasks[k], inputs[k],
+                        (None, None, {}, None))
+    elif args.read_ahead > 0:
+        # the inputs of the next pairs are read while a pair is aligned
+        for k, result in process_pairs_pipelined([(k, tasks[k])
+                                                  for k in todo],
+                                                 args.read_ahead,
+                                                 cache=tg_cache,
+                                                 prenucleus=args.prenucleus,
+                                                 warm=warm,
+                                                 pool=detect_pool):
+            collect(conll_tg_pairs[k], tasks[k], inputs[k], result)
+    else:
+        for k in todo:
+            try:
+                result = process_pair(*tasks[k],
+                                      pool=detect_pool,
+                                      cache=tg_cache,
+                                      prenucleus=args.prenucleus,
+                                      warm=warm)
+            except Exception as e:
+                err_print(u'{} : {}'.format(tasks[k][0], e))
+                result = (None, None, {}, None)
+            collect(conll_tg_pairs[k], tasks[k], inputs[k], result)
+
+    manifest.save()
+    save_encoding_cache()
+    save_ref_tiers(out_rep, ref_tiers)
+    # metrics of the run : those of the files summed up
+    # (the CPU time is the one of this process, workers excluded)
+    save_metrics(
+        metrics_path(out_rep, 'run'),
+        collections.OrderedDict([
+            ('date', time.strftime('%Y-%m-%d %H:%M:%S')),
+            ('args', vars(args)),
+            ('files', len(tasks)),
+            ('skipped_files', len(tasks) - len(todo)),
+            ('failed_files', len(tasks) - len(err)),
+            ('errors', sum(err.values())),
+            ('wall', round(time.time() - run_wall, 6)),
+            ('cpu', round(time.process_time() - run_cpu, 6)),
+            ('stages', run_metrics.report()),
+            ('distance_memo', collections.OrderedDict(
+                zip(['hits', 'misses'], distance_memo.stats()))),
+        ]))
 
     info_print("Summaray of processed file(s): ")
-    list_of_file_pair_print(conll_tg_pairs_bak, err_cnt=err, enc_dict=enc)
+    list_of_file_pair_print(conll_tg_pairs_bak,
+                            err_cnt=err,
+                            enc_dict=enc,
+                            timings=timings)
+    info_print(distance_memo.summary())
     #*****************************
+
+    # watch mode : export again each pair whose inputs change and the pairs
+    # requested in the spool folder, the TextGrids being kept in memory
+    if args.watch:
+        if args.spool and not os.path.exists(os.path.join(args.spool, 'done')):
+            os.makedirs(os.path.join(args.spool, 'done'))
+        info_print('watching {} and {} (Ctrl-C to stop)'.format(
+            args.conll_in, args.praat_in))
+        # (stopped by SIGTERM as by Ctrl-C)
+        import signal
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            while True:
+                time.sleep(args.poll)
+                requests = read_spool(args.spool) if args.spool else {}
+                conllFolderPath, conllFiles = listfiles(args.conll_in)
+                inputTgFolderPath, inputTgFiles = listfiles(args.praat_in)
+                for pair in make_paires(conllFiles, inputTgFiles):
+                    task = task_of(*pair)
+                    pair_requests = requests.pop(pair[0], [])
+                    try:
+                        task_inputs = manifest.inputs(*task[:3])
+                    except OSError:
+                        continue  # (removed in the meantime)
+                    # (a failed pair is retried once its inputs change)
+                    if not pair_requests and (
+                            manifest.done(task[2], task_inputs, options) or
+                            manifest.failed(task[2], task_inputs, options)):
+                        continue
+                    t0 = time.time()
+                    changed = max(os.path.getmtime(task[0]),
+                                  os.path.getmtime(task[1]))
+                    try:
+                        result = process_pair(*task,
+                                              pool=detect_pool,
+                                              cache=tg_cache,
+                                              prenucleus=args.prenucleus,
+                                              warm=warm)
+                    except Exception as e:
+                        err_print(u'{} : {}'.format(task[0], e))
+                        result = (None, None, {}, None)
+                    collect(pair, task, task_inputs, result)
+                    save_encoding_cache()
+                    save_ref_tiers(out_rep, ref_tiers)
+                    t1 = time.time()
+                    if pair_requests:
+                        info_print('{} : {} error(s), exported in {:.3f}s'.
+                                   format(pair[0], result[0], t1 - t0))
+                    else:
+                        info_print('{} : {} error(s), exported in {:.3f}s, '
+                                   '{:.3f}s after the change'.format(
+                                       pair[0], result[0], t1 - t0,
+                                       t1 - changed))
+                    for name, request, submitted in pair_requests:
+                        answer_request(
+                            args.spool, name,
+                            collections.OrderedDict([
+                                ('request', request), ('output', task[2]),
+                                ('errors', result[0]),
+                                ('ref_tier', result[3]),
+                                ('wall', round(t1 - t0, 6)),
+                                ('latency', round(t1 - submitted, 6)),
+                                ('stages', result[2])
+                            ]))
+                        info_print('request {} answered in {:.3f}s'.format(
+                            name, t1 - submitted))
+                for conll, pair_requests in requests.items():
+                    for name, request, submitted in pair_requests:
+                        answer_request(args.spool, name, {
+                            'request': request,
+                            'error': 'no pair for {}'.format(conll)
+                        })
+        except KeyboardInterrupt:
+            pass
+        manifest.save()
+        save_encoding_cache()
+        info_print(warm.summary())
+    if detect_pool is not None:
+        detect_pool.shutdown()
@@ -9,7 +9,7 @@
 #     Luigi Liu
 
 # dependencies
-import csv, os, argparse, collections, sys, codecs, re, struct, difflib, pympi.Praat, magic, chardet
+import csv, os, argparse, collections, sys, codecs, re, struct, difflib, array, bisect, time, mmap, json, atexit, hashlib, itertools, contextlib, threading, functools, pympi.Praat, magic, chardet
 
 # try tp enable javaobj for analor file support
 javaobj_installed = True
@@ -18,6 +18,13 @@ try:
 except Exception as e:
     javaobj_installed = False
 
+# try to enable numpy for the row-vectorized edit distance engine
+numpy_installed = True
+try:
+    import numpy
+except Exception as e:
+    numpy_installed = False
+
 # debug setting
 DEBUG_EN = False
 INFO_EN = True
@@ -27,26 +34,106 @@ ERR_EN = True
 
 # tools
 ## 1. visualisation & debug use
-def deb_print(x):
-    if DEBUG_EN: print('[Debug] {}'.format(x))
+# the message x is formatted with args only if it is printed
+def deb_print(x, *args):
+    if DEBUG_EN: print('[Debug] {}'.format(x.format(*args) if args else x))
+
+
+def info_print(x, *args):
+    if INFO_EN: print('[Info] {}'.format(x.format(*args) if args else x))
+
+
+def warning_print(x, *args):
+    if WARNING_EN:
+        print('[Warning] {} !'.format(x.format(*args) if args else x))
 
 
-def info_print(x):
-    if INFO_EN: print('[Info] {}'.format(x))
+def err_print(x, *args):
+    if ERR_EN: print('[Error] {} !!!'.format(x.format(*args) if args else x))
+
+
+# instrumentation of the processing of a file : wall and CPU time of each
+# stage and counters of the alignment, counted in the stage running
+class Metrics(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.stages = collections.OrderedDict()
+        self.current = None
+
+    def stage_entry(self, name):
+        entry = self.stages.get(name)
+        if entry is None:
+            entry = self.stages[name] = {
+                'wall': 0.0,
+                'cpu': 0.0,
+                'counters': collections.Counter()
+            }
+        return entry
+
+    # with metrics.stage('parsing'): ...
+    @contextlib.contextmanager
+    def stage(self, name):
+        entry = self.stage_entry(name)
+        outer, self.current = self.current, name
+        wall, cpu = time.time(), time.thread_time()
+        try:
+            yield entry
+        finally:
+            entry['wall'] += time.time() - wall
+            entry['cpu'] += time.thread_time() - cpu
+            self.current = outer
 
+    def count(self, name, n=1):
+        self.stage_entry(self.current or 'other')['counters'][name] += n
 
-def warning_print(x):
-    if WARNING_EN: print('[Warning] {} !'.format(x))
+    # counters of another process, added to the running stage
+    def add_counters(self, counters):
+        for name, n in counters.items():
+            self.count(name, n)
 
+    # the stages as a dict to dump in JSON
+    def report(self):
+        return collections.OrderedDict(
+            (name, {
+                'wall': round(entry['wall'], 6),
+                'cpu': round(entry['cpu'], 6),
+                'counters': dict(entry['counters'])
+            }) for name, entry in self.stages.items())
 
-def err_print(x):
-    if ERR_EN: print('[Error] {} !!!'.format(x))
+    # add the report of another file
+    def merge(self, report):
+        for name, entry in report.items():
+            total = self.stage_entry(name)
+            total['wall'] += entry['wall']
+            total['cpu'] += entry['cpu']
+            total['counters'].update(entry['counters'])
+
+
+metrics = Metrics()
+
+
+# metrics of the outputs of a folder, in JSON files of folder/.metrics :
+# one per output file and run.json for the whole run
+def metrics_path(folder, name):
+    return os.path.join(folder, '.metrics', name + '.json')
+
+
+def save_metrics(path, report):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, path)
 
 
 def list_of_file_pair_print(conll_tg_pairs,
                             err_cnt=None,
                             enc_dict=None,
-                            reverse=False):
+                            reverse=False,
+                            timings=None):
     if reverse:
         conll_tg_pairs = conll_tg_pairs[::-1]
     for n, p in enumerate(conll_tg_pairs):
@@ -67,6 +154,12 @@ def list_of_file_pair_print(conll_tg_pairs,
                 num_err = err_cnt[conll]
                 if num_err:
                     info_print('\tnumber of errors: {}'.format(num_err))
+        # wall time of each stage (from the metrics of the file)
+        if timings:
+            if conll in timings.keys() and timings[conll]:
+                info_print('\ttime: {}'.format(', '.join(
+                    '{} {:.2f}s'.format(stage, entry['wall'])
+                    for stage, entry in timings[conll].items())))
 
 
 ## 2. I/O handlers
@@ -74,7 +167,8 @@ def listfiles(path):
     filenames = None
     folder_path = None
     if os.path.isdir(path):
-        filenames = sorted(os.listdir(path))  # multiple files
+        # multiple files (hidden ones, as the encoding cache, are skipped)
+        filenames = sorted(f for f in os.listdir(path) if not f.startswith('.'))
         folder_path = path
     elif os.path.isfile(path):
         filename = os.path.basename(path)
@@ -82,6 +176,75 @@ def listfiles(path):
         folder_path = os.path.dirname(path)
     return folder_path, filenames
 
+# a sentence of a CoNLL-U file
+# tokens : forms of the tokens, pauses excluded
+# pauses : for each pause, the number of tokens before it
+# metadata : the metadata lines preceding the sentence
+# lines : index (from 0) of the line of each token in the file
+# end_line : index of the line ending the sentence (the empty line)
+class ConllSentence(object):
+    __slots__ = ('tokens', 'pauses', 'metadata', 'lines', 'end_line')
+
+    def __init__(self):
+        self.tokens = []
+        self.pauses = array.array('l')
+        self.metadata = []
+        self.lines = array.array('l')
+        self.end_line = -1
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def text(self):
+        return ' '.join(self.tokens)
+
+
+# streaming reader of the sentences of a CoNLL-U file, read in chunks
+# a line with less than 10 columns is taken as metadata and an empty line as
+# the end of a sentence, the last sentence needs no empty line after it
+def read_conll_sentences(conll_path,
+                         srcCol=2,
+                         pauseSign='#',
+                         chunk_size=1 << 16):
+    sent = ConllSentence()
+    n = 0
+    with open(conll_path, 'r') as f:
+        rest = ''
+        while True:
+            chunk = f.read(chunk_size)
+            if chunk:
+                lines = (rest + chunk).split('\n')
+                # keep the incomplete last line for the next chunk
+                rest = lines.pop()
+            else:
+                lines = [rest] if rest else []
+            for line in lines:
+                line = line.rstrip('\r')
+                # saute de ligne à la frontière des phrases
+                if not line:
+                    sent.end_line = n
+                    yield sent
+                    sent = ConllSentence()
+                else:
+                    row = line.split('\t')
+                    # les métadonnées
+                    if len(row) < 10:
+                        sent.metadata.append(line)
+                    # token dans une phrase
+                    elif row[srcCol - 1].strip() != pauseSign:
+                        sent.tokens.append(row[srcCol - 1])
+                        sent.lines.append(n)
+                    else:
+                        sent.pauses.append(len(sent.tokens))
+                n += 1
+            if not chunk:
+                break
+    # last sentence without empty line after it
+    if sent.tokens:
+        sent.end_line = n
+        yield sent
+
+
 # detectot of file coding
 def auto_decode(input):
     if input:
@@ -101,19 +264,650 @@ def auto_decode(input):
         return input
 
 # ref: https://stackoverflow.com/questions/436220/how-to-determine-the-encoding-of-text
-def get_encoding(filepath):
-    encoding = None
-    blob = open(filepath, 'rb').read()
+# libmagic detector, loaded once per process
+magic_detector = None
+# (a libmagic handle is not to be shared by threads)
+magic_lock = threading.Lock()
+
+
+def get_magic_detector():
+    global magic_detector
+    if magic_detector is None:
+        try:
+            magic_detector = magic.open(magic.MAGIC_MIME_ENCODING)
+            magic_detector.load()
+            atexit.register(magic_detector.close)
+        except Exception as e:
+            magic_detector = magic.Magic(mime_encoding=True)
+    return magic_detector
+
+
+# encodings already detected, by (path, size, mtime), see set_encoding_cache()
+encoding_cache = {}
+encoding_cache_path = None
+
+
+def encoding_cache_key(filepath):
+    stat = os.stat(filepath)
+    return u'{}|{}|{}'.format(os.path.abspath(filepath), stat.st_size,
+                              stat.st_mtime)
+
+
+# keep the detected encodings in a file, to skip the detection of unchanged
+# files in the next runs (see save_encoding_cache())
+def set_encoding_cache(path):
+    global encoding_cache_path
+    encoding_cache_path = path
+    if os.path.isfile(path):
+        try:
+            with open(path, 'r') as f:
+                encoding_cache.update(json.load(f))
+        except Exception as e:
+            warning_print(u'encoding cache {} ignored : {}'.format(path, e))
+
+
+def save_encoding_cache():
+    if encoding_cache_path:
+        tmp_path = encoding_cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(encoding_cache, f, indent=0, sort_keys=True)
+        os.replace(tmp_path, encoding_cache_path)
+
+
+def cache_encoding(filepath, encoding):
+    encoding_cache[encoding_cache_key(filepath)] = encoding
+
+
+# time reference tiers chosen by the exporter for the TextGrids of a folder,
+# recorded in the folder for identify_prenucleus.py
+def ref_tiers_path(folder):
+    return os.path.join(folder, '.ref_tiers.json')
+
+
+def load_ref_tiers(folder):
     try:
-        m = magic.open(magic.MAGIC_MIME_ENCODING)
-        m.load()
-        encoding = m.buffer(blob)  # "utf-8" "us-ascii" etc
-    except Exception as e:
-        m = magic.Magic(mime_encoding=True)
-        encoding = m.from_buffer(blob)
+        with open(ref_tiers_path(folder)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_ref_tiers(folder, ref_tiers):
+    recorded = load_ref_tiers(folder)
+    recorded.update(ref_tiers)
+    tmp_path = ref_tiers_path(folder) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(recorded, f, indent=0, sort_keys=True)
+    os.replace(tmp_path, ref_tiers_path(folder))
+
+
+def file_sha1(file_path):
+    h = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# version of the tool : hash of its sources
+def tool_version():
+    h = hashlib.sha1()
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for name in ['exporter.py', 'exporter_lib.py', 'identify_prenucleus.py']:
+        try:
+            with open(os.path.join(folder, name), 'rb') as f:
+                h.update(f.read())
+        except IOError:
+            pass
+    return h.hexdigest()[:12]
+
+
+# manifest of the pairs processed into an output folder : for each output,
+# the hashes of its inputs, the options of the run (version of the tool
+# included), the ref. tier, the number of errors and the encoding. An entry
+# is appended to folder/.manifest.jsonl as soon as its pair is done, so an
+# interrupted run loses no finished pair, and the file is compacted by save()
+class Manifest(object):
+    def __init__(self, folder):
+        self.path = os.path.join(folder, '.manifest.jsonl')
+        self.entries = {}
+        self.journal = None
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[os.path.basename(entry['output'])] = entry
+                    except (ValueError, KeyError):
+                        pass  # (last line cut by a crash)
+        except IOError:
+            pass
+
+    # hash of an input file, the recorded one being kept if the size and
+    # the mtime of the file are unchanged
+    def file_hash(self, file_path, recorded=None):
+        stat = os.stat(file_path)
+        if recorded and recorded.get('size') == stat.st_size and \
+                recorded.get('mtime') == stat.st_mtime_ns:
+            return recorded
+        return {
+            'sha1': file_sha1(file_path),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns
+        }
+
+    def inputs(self, conll_path, tg_path, output_path):
+        entry = self.entries.get(os.path.basename(output_path), {})
+        return {
+            'conll': self.file_hash(conll_path, entry.get('conll')),
+            'textgrid': self.file_hash(tg_path, entry.get('textgrid'))
+        }
+
+    # the entry of a pair recorded from the same inputs with the same
+    # options, None otherwise
+    def same(self, output_path, inputs, options):
+        entry = self.entries.get(os.path.basename(output_path))
+        if entry is None:
+            return None
+        for name in ['conll', 'textgrid']:
+            if entry[name]['sha1'] != inputs[name]['sha1']:
+                return None
+        if entry['options'] != options:
+            return None
+        return entry
+
+    # the entry of a pair already done from the same inputs with the same
+    # options, None if it has to be processed
+    def done(self, output_path, inputs, options):
+        entry = self.same(output_path, inputs, options)
+        if entry is None or entry.get('errors') is None or \
+                not os.path.isfile(output_path):
+            return None
+        return entry
+
+    # the entry of a pair which failed from the same inputs with the same
+    # options, None otherwise (in watch mode, it is retried only once its
+    # inputs change)
+    def failed(self, output_path, inputs, options):
+        entry = self.same(output_path, inputs, options)
+        if entry is None or entry.get('errors') is not None:
+            return None
+        return entry
+
+    def record(self, entry):
+        self.entries[os.path.basename(entry['output'])] = entry
+        if self.journal is None:
+            self.journal = open(self.path, 'a')
+        self.journal.write(json.dumps(entry, sort_keys=True) + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    # rewrite the manifest with the last entry of each output
+    def save(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for name in sorted(self.entries):
+                f.write(json.dumps(self.entries[name], sort_keys=True) + '\n')
+        os.replace(tmp_path, self.path)
+
+
+# byte order marks, the longest first
+boms = [(codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'),
+        (codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'),
+        (codecs.BOM_UTF16_BE, 'utf-16')]
+
+
+def get_encoding(filepath, prefix_size=1 << 16):
+    key = encoding_cache_key(filepath)
+    if key in encoding_cache:
+        return encoding_cache[key]
+
+    with open(filepath, 'rb') as f:
+        blob = f.read(prefix_size)
+        truncated = bool(f.read(1))
+    # binary Praat files need no text encoding
+    if blob.startswith(b'ooBinaryFile'):
+        encoding = 'binary'
+    else:
+        for bom, bom_encoding in boms:
+            if blob.startswith(bom):
+                encoding = bom_encoding
+                break
+        else:
+            # sniff the prefix, cut at the last line break to keep whole chars
+            if truncated and b'\n' in blob:
+                blob = blob[:blob.rindex(b'\n') + 1]
+            with magic_lock:
+                detector = get_magic_detector()
+                try:
+                    encoding = detector.buffer(blob)  # "utf-8" "us-ascii" etc
+                except AttributeError:
+                    encoding = detector.from_buffer(blob)
+            # the rest of the file may not be ascii, utf-8 is a superset of it
+            if truncated and encoding == 'us-ascii':
+                encoding = 'utf-8'
+
+    encoding_cache[key] = encoding
     return encoding
 
 
+# precompiled formats of the fields of Praat binary files (big endian)
+bin_float64 = struct.Struct('>d')
+bin_2float64 = struct.Struct('>dd')
+bin_int32 = struct.Struct('>i')
+bin_int16 = struct.Struct('>h')
+bin_uint16 = struct.Struct('>H')
+bin_interval = struct.Struct('>ddh')
+bin_point = struct.Struct('>dh')
+
+
+# read a string of a Praat binary file at offset in buf
+# return the string and the offset after it
+def bin_str_from(buf, offset):
+    textlen = bin_int16.unpack_from(buf, offset)[0]
+    offset += 2
+    # Single byte characters
+    if textlen >= 0:
+        return buf[offset:offset + textlen].decode('ascii'), offset + textlen
+    # Multi byte characters have initial len -1 and then \xff bytes
+    elif textlen == -1:
+        textlen = bin_uint16.unpack_from(buf, offset)[0] * 2
+        offset += 2
+        return buf[offset:offset + textlen].decode(
+            'utf-16-be', 'surrogatepass'), offset + textlen
+    return None, offset
+
+
+# a string in the format of a Praat binary file
+def bin_str_bytes(s):
+    try:
+        return bin_int16.pack(len(s)) + s.encode('ascii')
+    except UnicodeError:
+        data = s.encode('utf-16-be', 'surrogatepass')
+        return b'\xff\xff' + bin_uint16.pack(len(data) // 2) + data
+
+
+# a tier in the format of a Praat binary file, as pympi writes it
+def bin_tier_bytes(tier):
+    parts = [
+        bytes([len(tier.tier_type)]),
+        tier.tier_type.encode('ascii'),
+        bin_str_bytes(tier.name),
+        bin_2float64.pack(tier.xmin, tier.xmax)
+    ]
+    if isinstance(tier, ColumnarTier):
+        begins, ends, texts = tier.get_all_columns()
+    else:
+        ints = tier.get_all_intervals()
+        begins = [i[0] for i in ints]
+        ends = [i[1] for i in ints] if tier.tier_type == 'IntervalTier' \
+            else begins
+        texts = [i[-1] for i in ints]
+    parts.append(bin_int32.pack(len(begins)))
+    # (texts are repeated)
+    strings = {}
+    add = parts.append
+    if tier.tier_type == 'IntervalTier':
+        pack_dd = bin_2float64.pack
+        for x1, x2, text in zip(begins, ends, texts):
+            add(pack_dd(x1, x2))
+            data = strings.get(text)
+            if data is None:
+                data = strings[text] = bin_str_bytes(text)
+            add(data)
+    else:
+        pack_d = bin_float64.pack
+        for x1, text in zip(begins, texts):
+            add(pack_d(x1))
+            data = strings.get(text)
+            if data is None:
+                data = strings[text] = bin_str_bytes(text)
+            add(data)
+    return b''.join(parts)
+
+
+# map a binary file in memory, or read it if it can not be mapped
+def map_file(ifile):
+    try:
+        return mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+    except Exception as e:
+        ifile.seek(0, 0)
+        return ifile.read()
+
+
+# classes of the objects Praat may save in a Collection
+praat_classes = [
+    'TextGrid', 'Sound', 'LongSound', 'Pitch', 'PitchTier', 'Intensity',
+    'IntensityTier', 'Formant', 'FormantGrid', 'FormantTier', 'Spectrum',
+    'Spectrogram', 'Ltas', 'PointProcess', 'Manipulation', 'DurationTier',
+    'AmplitudeTier', 'Harmonicity', 'Matrix', 'Table', 'TableOfReal',
+    'Strings', 'MFCC', 'Cochleagram', 'Excitation', 'Polygon'
+]
+# class name preceded by its length, as in the header of an object
+praat_class_headers = re.compile(b'|'.join(
+    re.escape(bytes(bytearray([len(c)])) + c.encode('ascii'))
+    for c in sorted(praat_classes, key=len, reverse=True)))
+
+
+# read the header of an object in a binary Collection : class name and name
+# return None if there is no valid header at offset
+def collection_object_header(buf, offset):
+    try:
+        textlen = buf[offset]
+        class_name = buf[offset + 1:offset + 1 + textlen].decode('ascii')
+        name, payload_offset = bin_str_from(buf, offset + 1 + textlen)
+    except Exception as e:
+        return None
+    if name is None or payload_offset > len(buf) or \
+            class_name not in praat_classes:
+        return None
+    return class_name, name, payload_offset
+
+
+# walk the objects of a binary Collection, yield for each of them
+# (class name, name, offset of the header, offset of the payload)
+# only TextGrid payloads can be parsed to jump to the next object, after
+# another object the next one is found by searching the known class headers
+def iter_collection_objects(buf, offset):
+    size = bin_int32.unpack_from(buf, offset)[0]
+    offset += 4
+    for k in range(size):
+        header = collection_object_header(buf, offset)
+        if header is None:
+            # search the next valid header
+            match = praat_class_headers.search(buf, offset)
+            while match:
+                header = collection_object_header(buf, match.start())
+                if header is not None:
+                    break
+                match = praat_class_headers.search(buf, match.start() + 1)
+            if header is None:
+                return
+            offset = match.start()
+        class_name, name, payload_offset = header
+        yield class_name, name, offset, payload_offset
+        if class_name == 'TextGrid':
+            # (a plain TextGrid is enough to hold the parsed tiers)
+            offset = TextGridPlus.from_bin_buffer(
+                pympi.Praat.TextGrid(xmax=0), buf, payload_offset)
+        else:
+            offset = payload_offset
+
+
+# directory of the objects of a binary Collection file
+def collection_directory(file_path):
+    with open(file_path, 'rb') as ifile:
+        buf = map_file(ifile)
+        try:
+            if buf[:12] != b'ooBinaryFile' or \
+                    buf[13:13 + buf[12]] != b'Collection':
+                raise Exception('Not a binary Collection.')
+            return list(iter_collection_objects(buf, 13 + buf[12]))
+        finally:
+            if isinstance(buf, mmap.mmap):
+                buf.close()
+
+
+# values of a TextGrid file in long or short text format : the quoted strings
+# (with "" for ", possibly over several lines), the numbers and the flags in
+# their order in the file, the labels of the long format are skipped
+def textgrid_values(text):
+    # split the file at the quotes : strings at odd indexes
+    parts = text.split('"')
+    # an empty part between two strings is an escaped quote, merge them
+    if '' in parts[2:-1:2]:
+        merged = [parts[0]]
+        k = 1
+        while k < len(parts):
+            string = parts[k]
+            while k + 2 < len(parts) and parts[k + 1] == '':
+                string += '"' + parts[k + 2]
+                k += 2
+            merged.append(string)
+            if k + 1 < len(parts):
+                merged.append(parts[k + 1])
+            k += 2
+        parts = merged
+    strings = iter(parts[1::2])
+
+    # scan the rest, a NUL char. standing for each string
+    values = []
+    append = values.append
+    for token in '\x00'.join(parts[0::2]).split():
+        c = token[0]
+        if c in '0123456789-+.':
+            append(token)
+        elif '\x00' in token:
+            for k in range(token.count('\x00')):
+                append(next(strings))
+        elif token in ('<exists>', '<absent>'):
+            append(token)
+    return values
+
+
+# a tier held by columns : the begin / end times in arrays and the texts in a
+# list (of strings shared between equal texts), in place of the list of
+# (x1, x2, text) / (x1, text) tuples of pympi. Intervals are sorted by time
+# on first lookup, then kept sorted : a time or a time window is then
+# located by bisection. The list of tuples `intervals` is built on demand,
+# so the methods of pympi.Praat.Tier keep working.
+class ColumnarTier(pympi.Praat.Tier):
+    def __init__(self, xmin, xmax, name=None, tier_type=None, begins=None,
+                 ends=None, texts=None):
+        if tier_type not in self.P_TIERS:
+            raise Exception('Tiertype does not exist.')
+        self.name = name
+        self.tier_type = tier_type
+        self.xmin, self.xmax = xmin, xmax
+        if begins is None:
+            begins, ends, texts = array.array('d'), array.array('d'), []
+        self.set_columns(begins, ends, texts)
+
+    def set_columns(self, begins, ends, texts):
+        self.begins = begins
+        # (no end column for a TextTier)
+        self.ends = ends if self.tier_type == 'IntervalTier' else None
+        self.texts = texts
+        self.ordered = False
+        self.all_columns = None
+        self.source = None
+
+    # keep the bytes of the tier in the binary file it is read from, they are
+    # written back as they are while the tier is unchanged
+    def keep_source(self, data):
+        self.source = (data, self.name, self.xmin, self.xmax)
+
+    def source_bytes(self):
+        if self.source is None:
+            return None
+        data, name, xmin, xmax = self.source
+        if (name, xmin, xmax) != (self.name, self.xmin, self.xmax):
+            return None
+        return data
+
+    @property
+    def intervals(self):
+        if self.ends is None:
+            return list(zip(self.begins, self.texts))
+        return list(zip(self.begins, self.ends, self.texts))
+
+    @intervals.setter
+    def intervals(self, intervals):
+        if self.tier_type == 'IntervalTier':
+            self.set_columns(array.array('d', (i[0] for i in intervals)),
+                             array.array('d', (i[1] for i in intervals)),
+                             [i[2] for i in intervals])
+        else:
+            self.set_columns(array.array('d', (i[0] for i in intervals)),
+                             None, [i[1] for i in intervals])
+
+    def __len__(self):
+        return len(self.begins)
+
+    def sort_columns(self):
+        if self.ordered:
+            return
+        # (by begin then end time : the ends are then sorted too)
+        begins, ends = self.begins, self.ends
+        if any(map(float.__gt__, begins, begins[1:])) or \
+                (ends is not None and any(map(float.__gt__, ends, ends[1:]))):
+            if ends is None:
+                order = sorted(range(len(begins)), key=begins.__getitem__)
+            else:
+                order = sorted(range(len(begins)),
+                               key=lambda k: (begins[k], ends[k]))
+            self.begins = array.array('d', (begins[k] for k in order))
+            if self.ends is not None:
+                self.ends = array.array('d', (self.ends[k] for k in order))
+            self.texts = [self.texts[k] for k in order]
+            self.source = None
+        self.ordered = True
+
+    def interval(self, n):
+        if self.ends is None:
+            return self.begins[n], self.texts[n]
+        return self.begins[n], self.ends[n], self.texts[n]
+
+    def index_at(self, time):
+        """Index of the interval holding time (of the last point before time
+        for a TextTier), -1 if none."""
+        self.sort_columns()
+        n = bisect.bisect_right(self.begins, time) - 1
+        if n >= 0 and self.ends is not None and time >= self.ends[n]:
+            return -1
+        return n
+
+    def index_range(self, tmin, tmax):
+        """Range [lo, hi) of the indices of the intervals (points) within
+        [tmin, tmax]."""
+        self.sort_columns()
+        lo = bisect.bisect_left(self.begins, tmin)
+        hi = bisect.bisect_right(
+            self.begins if self.ends is None else self.ends, tmax)
+        return lo, max(lo, hi)
+
+    def add_point(self, point, value, check=True):
+        if self.tier_type != 'TextTier':
+            raise Exception('Tiertype must be TextTier.')
+        self.sort_columns()
+        n = bisect.bisect_right(self.begins, point)
+        if check and n and self.begins[n - 1] == point:
+            raise Exception('No overlap is allowed')
+        self.begins.insert(n, point)
+        self.texts.insert(n, value)
+        self.all_columns = None
+        self.source = None
+
+    def add_interval(self, begin, end, value, check=True):
+        if self.tier_type != 'IntervalTier':
+            raise Exception('Tiertype must be IntervalTier')
+        self.sort_columns()
+        n = bisect.bisect_right(self.begins, begin)
+        while n and self.begins[n - 1] == begin and self.ends[n - 1] > end:
+            n -= 1
+        if check:
+            # only the neighbours may overlap
+            if (n and begin < self.ends[n - 1] and
+                    end > self.begins[n - 1]) or \
+                    (n < len(self.begins) and self.begins[n] < end and
+                     self.ends[n] > begin):
+                raise Exception('No overlap is allowed')
+            if begin > end:
+                raise Exception('Begin must be smaller then end')
+        self.begins.insert(n, begin)
+        self.ends.insert(n, end)
+        self.texts.insert(n, value)
+        self.all_columns = None
+        self.source = None
+
+    def get_intervals(self, sort=False):
+        if sort:
+            self.sort_columns()
+        if self.ends is None:
+            return zip(self.begins, self.texts)
+        return zip(self.begins, self.ends, self.texts)
+
+    def get_all_columns(self):
+        """Columns of get_all_intervals() : begins, ends (the begins for a
+        TextTier) and texts, the gaps being filled with empty intervals.
+        They are not copied : without gaps they are the columns of the tier
+        itself, and the same arrays are returned until the tier changes, so
+        they must only be read."""
+        if self.all_columns is None:
+            self.sort_columns()
+            begins, ends, texts = self.begins, self.ends, self.texts
+            if ends is None:
+                self.all_columns = begins, begins, texts
+            elif len(begins) and begins[0] <= self.xmin and \
+                    ends[-1] >= self.xmax and \
+                    memoryview(begins)[1:] == memoryview(ends)[:-1]:
+                # no gap, the usual case of a tier read from a file
+                self.all_columns = begins, ends, texts
+            else:
+                ints = pympi.Praat.Tier.get_all_intervals(self)
+                self.all_columns = (array.array('d', (i[0] for i in ints)),
+                                    array.array('d', (i[1] for i in ints)),
+                                    [i[2] for i in ints])
+        return self.all_columns
+
+    def get_all_intervals(self):
+        begins, ends, texts = self.get_all_columns()
+        if self.ends is None:
+            return list(zip(begins, texts))
+        return list(zip(begins, ends, texts))
+
+
+# batch of intervals to add to an IntervalTier : they are collected, checked
+# for overlaps (with the intervals of the tier as well) in the order they were
+# added and set in the tier at once. As with successive calls of
+# add_interval(check=True), an interval is rejected if it overlaps one kept
+# before it; each interval rejected is reported with its line (of the CoNLL).
+# The intervals kept do not overlap, so sorted by time their ends are sorted
+# too : only the last one beginning before the end of an interval may
+# overlap it, which is found by bisection.
+class TierBuilder(object):
+    def __init__(self, tier):
+        self.tier = tier
+        self.pending = []
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add_interval(self, begin, end, value, line=None):
+        self.pending.append((begin, end, len(self.pending), value, line))
+
+    def commit(self):
+        """Add the intervals collected to the tier.
+        :returns: List of (line, message) of the intervals rejected.
+        """
+        # (the intervals of the tier come first)
+        items = [(x1, x2, -1, text, None)
+                 for x1, x2, text in self.tier.get_intervals()]
+        items.extend(self.pending)
+        conflicts = []
+        # (begin, end) of the intervals kept, sorted, and the intervals
+        keys = []
+        kept = []
+        for item in items:
+            begin, end, rank, value, line = item
+            n = bisect.bisect_left(keys, (end, float('-inf')))
+            if n and begin < keys[n - 1][1] and end > keys[n - 1][0]:
+                conflicts.append((line, 'No overlap is allowed'))
+            elif begin > end:
+                conflicts.append((line, 'Begin must be smaller then end'))
+            else:
+                n = bisect.bisect_right(keys, (begin, end))
+                keys.insert(n, (begin, end))
+                kept.insert(n, (begin, end, value))
+        self.tier.intervals = kept
+        self.pending = []
+        conflicts.sort(key=lambda conflict: (conflict[0] is None, conflict[0]))
+        return conflicts
+
+
 # extend original TextGrid reader to
 # 1.support praat Collection
 # 2. Analor .or (this functionality works under python 2)
@@ -163,19 +957,17 @@ class TextGridPlus(pympi.Praat.TextGrid):
                         raise Exception('Tiertype does not exist.')
 
                     # form a tier
-                    tier = pympi.Praat.Tier(0,
-                                            0,
-                                            name=nom,
-                                            tier_type=tier_type)
+                    tier = ColumnarTier(0,
+                                        0,
+                                        name=nom,
+                                        tier_type=tier_type)
                     self.tiers.append(tier)
                     tier.xmin = tlims[0]
                     tier.xmax = tlims[-1]
                     if tier.tier_type == 'IntervalTier':
-                        for x1, x2, text in zip(bornes, bornes[1:], mots):
-                            tier.intervals.append((x1, x2, text))
+                        tier.intervals = list(zip(bornes, bornes[1:], mots))
                     elif tier.tier_type == 'TextTier':
-                        for x1, text in zip(bornes, mots):
-                            tier.intervals.append((x1, text))
+                        tier.intervals = list(zip(bornes, mots))
                     else:
                         raise Exception('Tiertype does not exist.')
 
@@ -190,9 +982,43 @@ class TextGridPlus(pympi.Praat.TextGrid):
 
     # extend the original class constructor to have an additional arugment 'analorFileEn'
     # in order to control if enable / disable Ananor File support (ie. .or)
-    def __init__(self, file_path, codec, analorFileEn=False):
+    # (an empty TextGrid is created, as in pympi, when file_path is None)
+    def __init__(self, file_path, codec, analorFileEn=False, xmax=None):
         self.analorFileEn = analorFileEn
-        pympi.Praat.TextGrid.__init__(self, file_path=file_path, codec=codec)
+        pympi.Praat.TextGrid.__init__(self,
+                                      file_path=file_path,
+                                      xmax=xmax,
+                                      codec=codec)
+
+    # in binary mode, the tiers unchanged since read from a binary file are
+    # copied as they are, the others are written as pympi does
+    def to_file(self, filepath, codec='utf-8', mode='normal'):
+        if mode not in ['binary', 'b']:
+            return pympi.Praat.TextGrid.to_file(self, filepath, codec, mode)
+        self.tier_num = len(self.tiers)
+        with open(filepath, 'wb') as f:
+            f.write(b'ooBinaryFile\x08TextGrid')
+            f.write(bin_2float64.pack(self.xmin, self.xmax))
+            f.write(b'\x01')
+            f.write(bin_int32.pack(self.tier_num))
+            for tier in self.tiers:
+                data = None
+                if isinstance(tier, ColumnarTier):
+                    data = tier.source_bytes()
+                f.write(bin_tier_bytes(tier) if data is None else data)
+
+    # the tiers added are columnar too
+    def add_tier(self, name, tier_type='IntervalTier', number=None):
+        if number is None:
+            number = len(self.tiers) + 1
+        elif number < 1 or number > len(self.tiers):
+            raise ValueError('Number not in [1..{}]'.format(len(self.tiers)))
+        if tier_type not in pympi.Praat.Tier.P_TIERS:
+            raise ValueError('tier_type has to be in {}'.format(
+                pympi.Praat.Tier.P_TIERS))
+        self.tiers.insert(number - 1,
+                          ColumnarTier(self.xmin, self.xmax, name, tier_type))
+        return self.tiers[number - 1]
 
     def from_file(self, ifile, codec='ascii'):
         """Read textgrid from stream.
@@ -211,110 +1037,401 @@ class TextGridPlus(pympi.Praat.TextGrid):
             # read a Textgrid or extract TextGrid from Collection in Binary Format
             if ifile.read(12) == b'ooBinaryFile':
 
-                def bin2str(ifile):
-                    textlen = struct.unpack('>h', ifile.read(2))[0]
-                    # Single byte characters
-                    if textlen >= 0:
-                        return ifile.read(textlen).decode('ascii')
-
-                    # Multi byte characters have initial len -1 and then \xff bytes
-                    elif textlen == -1:
-                        textlen = struct.unpack('>h', ifile.read(2))[0]
-                        data = ifile.read(textlen * 2)
-                        # Hack to go from number to unicode in python3 and python2
-                        fun = unichr if 'unichr' in __builtins__ else chr
-                        charlist = (data[i:i + 2]
-                                    for i in range(0, len(data), 2))
-                        return u''.join(
-                            fun(struct.unpack('>h', i)[0]) for i in charlist)
-
-
-                # only difference is here :in the case of a Praat Collection
-                # jump to the begining of the embedded TextGrid object
-                if ifile.read(ord(
-                        ifile.read(1))) == b'Collection':  # skip oo type
-                    self.jump2TextGridBin(ifile, codec)
-
-                self.xmin = struct.unpack('>d', ifile.read(8))[0]
-                self.xmax = struct.unpack('>d', ifile.read(8))[0]
-                ifile.read(1)  # skip <exists>
-                self.tier_num = struct.unpack('>i', ifile.read(4))[0]
-                for i in range(self.tier_num):
-                    tier_type = ifile.read(ord(ifile.read(1))).decode('ascii')
-                    name = bin2str(ifile)
-                    tier = pympi.Praat.Tier(0,
-                                            0,
-                                            name=name,
-                                            tier_type=tier_type)
-                    self.tiers.append(tier)
-                    tier.xmin = struct.unpack('>d', ifile.read(8))[0]
-                    tier.xmax = struct.unpack('>d', ifile.read(8))[0]
-                    nint = struct.unpack('>i', ifile.read(4))[0]
-                    for i in range(nint):
-                        x1 = struct.unpack('>d', ifile.read(8))[0]
-                        if tier.tier_type == 'IntervalTier':
-                            x2 = struct.unpack('>d', ifile.read(8))[0]
-                        text = bin2str(ifile)
-                        if tier.tier_type == 'IntervalTier':
-                            tier.intervals.append((x1, x2, text))
-                        elif tier.tier_type == 'TextTier':
-                            tier.intervals.append((x1, text))
-                        else:
-                            raise Exception('Tiertype does not exist.')
+                # map (or read) the file at once and parse it in memory
+                buf = map_file(ifile)
+                try:
+                    offset = 13 + buf[12]  # skip oo type
+                    # only difference is here :in the case of a Praat Collection
+                    # jump to the begining of the embedded TextGrid object
+                    if buf[13:offset] == b'Collection':
+                        offset = self.jump2TextGridBin(buf, offset)
+                    self.from_bin_buffer(buf, offset)
+                finally:
+                    if isinstance(buf, mmap.mmap):
+                        buf.close()
         # read a TextGrid file in long/ short text format
             else:
-
-                def nn(ifile, pat):
-                    line = next(ifile).decode(codec)
-                    return pat.search(line).group(1)
-
-                regfloat = re.compile('([\d.]+)\s*$', flags=re.UNICODE)
-                regint = re.compile('([\d]+)\s*$', flags=re.UNICODE)
-                regstr = re.compile('"(.*)"\s*$', flags=re.UNICODE)
-                # Skip the Headers and empty line
-                next(ifile), next(ifile), next(ifile)
-                self.xmin = float(nn(ifile, regfloat))
-                self.xmax = float(nn(ifile, regfloat))
-                # Skip <exists>
-                line = next(ifile)
-                short = line.strip() == b'<exists>'
-                self.tier_num = int(nn(ifile, regint))
-                not short and next(ifile)
-                for i in range(self.tier_num):
-                    not short and next(ifile)  # skip item[]: and item[\d]:
-                    tier_type = nn(ifile, regstr)
-                    name = nn(ifile, regstr)
-                    tier = pympi.Praat.Tier(0,
-                                            0,
-                                            name=name,
-                                            tier_type=tier_type)
-                    self.tiers.append(tier)
-
-                    tier.xmin = float(nn(ifile, regfloat))
-                    tier.xmax = float(nn(ifile, regfloat))
-                    for i in range(int(nn(ifile, regint))):
-                        not short and next(ifile)  # skip intervals [\d]
-                        x1 = float(nn(ifile, regfloat))
-                        if tier.tier_type == 'IntervalTier':
-                            x2 = float(nn(ifile, regfloat))
-                            t = nn(ifile, regstr)
-                            tier.intervals.append((x1, x2, t))
-                        elif tier.tier_type == 'TextTier':
-                            t = nn(ifile, regstr)
-                            tier.intervals.append((x1, t))
-
-    def jump2TextGridBin(self, ifile, codec='ascii', keyword=b'\x08TextGrid'):
-        binstr = b''
-        while ifile:
-            binstr += ifile.read(1)
-            if len(binstr) > len(keyword):
-                binstr = binstr[1:]
-            if binstr == keyword:
+                # decode the whole file at once
+                ifile.seek(0, 0)
+                data = ifile.read()
+                try:
+                    text = data.decode(codec)
+                except (LookupError, TypeError):
+                    text = data.decode(
+                        chardet.detect(data)['encoding'] or 'utf-8', 'replace')
+                self.from_text_buffer(text)
+
+    def from_text_buffer(self, text):
+        """Read a TextGrid in long or short text format from a string.
+        :param str text: Decoded content of the file.
+        """
+        values = textgrid_values(text)
+
+        # Skip the Headers
+        k = 0
+        if values[:2] == ['ooTextFile', 'TextGrid']:
+            k = 2
+        self.xmin = float(values[k])
+        self.xmax = float(values[k + 1])
+        if values[k + 2] == '<absent>':
+            self.tier_num = 0
+            return
+        self.tier_num = int(values[k + 3])
+        k += 4
+        strings = {}  # equal texts share a string
+        for i in range(self.tier_num):
+            tier_type = values[k]
+            name = values[k + 1]
+            xmin = float(values[k + 2])
+            xmax = float(values[k + 3])
+            nint = int(values[k + 4])
+            k += 5
+            if tier_type == 'IntervalTier':
+                begins = array.array('d', map(float, values[k:k + 3 * nint:3]))
+                ends = array.array('d',
+                                   map(float, values[k + 1:k + 3 * nint:3]))
+                texts = [
+                    strings.setdefault(t, t)
+                    for t in values[k + 2:k + 3 * nint:3]
+                ]
+                k += 3 * nint
+            elif tier_type == 'TextTier':
+                begins = array.array('d', map(float, values[k:k + 2 * nint:2]))
+                ends = None
+                texts = [
+                    strings.setdefault(t, t)
+                    for t in values[k + 1:k + 2 * nint:2]
+                ]
+                k += 2 * nint
+            else:
+                raise Exception('Tiertype does not exist.')
+            self.tiers.append(
+                ColumnarTier(xmin, xmax, name, tier_type, begins, ends, texts))
+
+    def from_bin_buffer(self, buf, offset=0):
+        """Read the content of a binary TextGrid from a buffer.
+        :param bytes buf: Buffer holding the TextGrid object.
+        :param int offset: Offset of the TextGrid object in the buffer, just
+            after its class name.
+        :returns: Offset of the end of the TextGrid object.
+        """
+        unpack_d = bin_float64.unpack_from
+        unpack_dd = bin_2float64.unpack_from
+        unpack_i = bin_int32.unpack_from
+        # the header of an interval / a point and the length of its text
+        unpack_ddh = bin_interval.unpack_from
+        unpack_dh = bin_point.unpack_from
+
+        self.xmin, self.xmax = unpack_dd(buf, offset)
+        offset += 17  # skip <exists>
+        self.tier_num = unpack_i(buf, offset)[0]
+        offset += 4
+        strings = {}  # equal texts share a string
+        intern = strings.setdefault
+        for i in range(self.tier_num):
+            tier_offset = offset
+            textlen = buf[offset]
+            tier_type = buf[offset + 1:offset + 1 + textlen].decode('ascii')
+            name, offset = bin_str_from(buf, offset + 1 + textlen)
+            xmin, xmax = unpack_dd(buf, offset)
+            nint = unpack_i(buf, offset + 16)[0]
+            offset += 20
+            begins = array.array('d')
+            texts = []
+            add_begin, add_text = begins.append, texts.append
+            if tier_type == 'IntervalTier':
+                ends = array.array('d')
+                add_end = ends.append
+                for i in range(nint):
+                    x1, x2, textlen = unpack_ddh(buf, offset)
+                    offset += 18
+                    if textlen >= 0:  # single byte characters
+                        text = buf[offset:offset + textlen].decode('ascii')
+                        offset += textlen
+                    else:
+                        text, offset = bin_str_from(buf, offset - 2)
+                    add_begin(x1)
+                    add_end(x2)
+                    add_text(intern(text, text))
+            elif tier_type == 'TextTier':
+                ends = None
+                for i in range(nint):
+                    x1, textlen = unpack_dh(buf, offset)
+                    offset += 10
+                    if textlen >= 0:  # single byte characters
+                        text = buf[offset:offset + textlen].decode('ascii')
+                        offset += textlen
+                    else:
+                        text, offset = bin_str_from(buf, offset - 2)
+                    add_begin(x1)
+                    add_text(intern(text, text))
+            else:
+                raise Exception('Tiertype does not exist.')
+            tier = ColumnarTier(xmin, xmax, name, tier_type, begins, ends,
+                                texts)
+            tier.keep_source(bytes(buf[tier_offset:offset]))
+            self.tiers.append(tier)
+        return offset
+
+    def jump2TextGridBin(self, buf, offset, keyword=b'\x08TextGrid'):
+        """Locate the first TextGrid object of a binary Collection.
+        :param bytes buf: Buffer holding the Collection file.
+        :param int offset: Offset just after the 'Collection' class name.
+        :returns: Offset of the TextGrid object, just after its name.
+        """
+        for class_name, name, header_offset, payload_offset in \
+                iter_collection_objects(buf, offset):
+            if class_name == keyword[1:].decode('ascii'):
+                return payload_offset
+        # unknown objects may hide the TextGrid, look for its class name
+        header_offset = buf.find(keyword, offset)
+        if header_offset < 0:
+            raise Exception('No TextGrid in the Collection.')
+        name, payload_offset = bin_str_from(buf, header_offset + len(keyword))
+        return payload_offset
+
+
+# on-disk cache of parsed TextGrids
+#
+# an entry holds a TextGrid in a columnar form : a JSON header (bounds and
+# tiers of the TextGrid, table of the distinct texts) followed, for each tier,
+# by the arrays of its times and of the indices of its texts in the table.
+# Entries are keyed by the hash of the file content, the codec and the version
+# of the parsers; the least recently used ones are removed past max_bytes.
+textgrid_cache_version = 1
+textgrid_cache_magic = b'conll2praat-tgc'
+
+
+class TextGridCache(object):
+    def __init__(self, cache_dir, max_bytes=1 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, file_path, codec, analorFileEn=False):
+        h = hashlib.sha1('{}|{}|{}|{}|'.format(textgrid_cache_version, codec,
+                                               analorFileEn,
+                                               sys.byteorder).encode('utf-8'))
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + '.tgc')
+
+    def load(self, file_path, codec, analorFileEn=False, key=None):
+        """Load a parsed TextGrid from the cache.
+        :returns: TextGridPlus or None if the file is not in the cache.
+        """
+        path = self.entry_path(key or self.key(file_path, codec, analorFileEn))
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            tg = textgrid_from_columns(data, codec, analorFileEn)
+        except Exception as e:
+            if os.path.exists(path):
+                warning_print('corrupted cache entry {} : {}'.format(path, e))
+                os.remove(path)
+            self.misses += 1
+            return None
+        # least recently used entries are the oldest ones
+        os.utime(path, None)
+        self.hits += 1
+        return tg
+
+    def store(self, tg, file_path, codec, analorFileEn=False, key=None):
+        path = self.entry_path(key or self.key(file_path, codec, analorFileEn))
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(),
+                                         threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(textgrid_to_columns(tg))
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith('.tgc'):
+                try:
+                    st = os.stat(os.path.join(self.cache_dir, filename))
+                except OSError:  # removed by another process
+                    continue
+                entries.append((st.st_mtime, st.st_size, filename))
+        total = sum(size for mtime, size, filename in entries)
+        for mtime, size, filename in sorted(entries):
+            if total <= self.max_bytes:
                 break
-        lg = struct.unpack('>h', ifile.read(2))[0]
-        if lg == -1:
-            lg = lg.astype('>H')
-        objname = ifile.read(lg).decode('ascii')  # skip embeded oo name
+            try:
+                os.remove(os.path.join(self.cache_dir, filename))
+            except OSError:
+                pass
+            total -= size
+
+    def get(self, file_path, codec, analorFileEn=False):
+        """Load a TextGrid from the cache, or parse it and cache it."""
+        return self.lookup(file_path, codec, analorFileEn)[0]
+
+    # get() and whether the TextGrid was in the cache
+    def lookup(self, file_path, codec, analorFileEn=False):
+        key = self.key(file_path, codec, analorFileEn)
+        tg = self.load(file_path, codec, analorFileEn, key=key)
+        if tg is not None:
+            return tg, True
+        tg = TextGridPlus(file_path=file_path,
+                          codec=codec,
+                          analorFileEn=analorFileEn)
+        self.store(tg, file_path, codec, analorFileEn, key=key)
+        return tg, False
+
+    def summary(self):
+        return 'TextGrid cache {} : {} hit(s), {} miss(es)'.format(
+            self.cache_dir, self.hits, self.misses)
+
+
+def textgrid_to_columns(tg):
+    strings = {}
+    tiers = []
+    columns = []
+    for tier in tg.tiers:
+        if not isinstance(tier, ColumnarTier):
+            tier = ColumnarTier(tier.xmin, tier.xmax, tier.name,
+                                tier.tier_type)
+            tier.intervals = tg.tiers[len(tiers)].intervals
+        columns.append(tier.begins)
+        if tier.tier_type == 'IntervalTier':
+            columns.append(tier.ends)
+        columns.append(
+            array.array('i', [
+                strings.setdefault(text, len(strings)) for text in tier.texts
+            ]))
+        tiers.append([tier.name, tier.tier_type, tier.xmin, tier.xmax,
+                      len(tier)])
+    header = json.dumps({
+        'xmin': tg.xmin,
+        'xmax': tg.xmax,
+        'tiers': tiers,
+        'strings': list(strings)
+    }).encode('utf-8')
+    return b''.join([textgrid_cache_magic,
+                     bin_int32.pack(len(header)), header] +
+                    [c.tobytes() for c in columns])
+
+
+def textgrid_from_columns(data, codec, analorFileEn=False):
+    if not data.startswith(textgrid_cache_magic):
+        raise Exception('not a cache entry')
+    offset = len(textgrid_cache_magic)
+    header_len = bin_int32.unpack_from(data, offset)[0]
+    offset += 4
+    header = json.loads(data[offset:offset + header_len].decode('utf-8'))
+    offset += header_len
+    strings = header['strings']
+    view = memoryview(data)
+
+    def column(typecode, n):
+        nonlocal offset
+        col = array.array(typecode)
+        col.frombytes(view[offset:offset + n * col.itemsize])
+        offset += n * col.itemsize
+        return col
+
+    tg = TextGridPlus(None,
+                      codec,
+                      analorFileEn=analorFileEn,
+                      xmax=header['xmax'])
+    tg.xmin = header['xmin']
+    for name, tier_type, xmin, xmax, n in header['tiers']:
+        begins = column('d', n)
+        ends = column('d', n) if tier_type == 'IntervalTier' else None
+        texts = list(map(strings.__getitem__, column('i', n)))
+        tg.tiers.append(
+            ColumnarTier(xmin, xmax, name, tier_type, begins, ends, texts))
+    tg.tier_num = len(tg.tiers)
+    if offset != len(data):
+        raise Exception('truncated cache entry')
+    return tg
+
+
+# parse a TextGrid file, through the cache if any
+def load_textgrid(file_path, codec, analorFileEn=False, cache=None):
+    if cache is None:
+        return TextGridPlus(file_path=file_path,
+                            codec=codec,
+                            analorFileEn=analorFileEn)
+    return cache.get(file_path, codec, analorFileEn)
+
+
+# a TextGrid kept in memory : its tiers as read, the indexes of its ref.
+# tiers and the ref. tier detected for it
+class WarmTextGrid(object):
+    __slots__ = ('tg', 'tiers', 'ref_indexes', 'ref_names')
+
+    def __init__(self, tg):
+        self.tg = tg
+        self.tiers = list(tg.tiers)
+        self.ref_indexes = {}
+        # ref. tier detected with each CoNLL file, by path, with the size and
+        # mtime of the file (see encoding_cache_key())
+        self.ref_names = {}
+
+    def ref_index(self, name):
+        if name not in self.ref_indexes:
+            self.ref_indexes[name] = RefTierIndex(self.tg.get_tier(name))
+        return self.ref_indexes[name]
+
+    # the ref. tier detected before with the same CoNLL file, None if the
+    # file has changed since
+    def ref_name(self, conll_path, conll_key):
+        key, name = self.ref_names.get(os.path.abspath(conll_path),
+                                       (None, None))
+        return name if key == conll_key else None
+
+    def set_ref_name(self, conll_path, conll_key, name):
+        self.ref_names[os.path.abspath(conll_path)] = (conll_key, name)
+
+
+# parsed TextGrids kept in memory by a long-running exporter (--watch), by
+# path, with the size and mtime of the file (see encoding_cache_key()), the
+# least recently used ones being dropped beyond max_entries
+class WarmTextGridCache(object):
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, file_path, key):
+        path = os.path.abspath(file_path)
+        with self.lock:
+            item = self.entries.get(path)
+            if item is None or item[0] != key:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(path)
+            self.hits += 1
+        entry = item[1]
+        # (the tiers added by the previous export are dropped)
+        entry.tg.tiers = list(entry.tiers)
+        return entry
+
+    def put(self, file_path, key, tg):
+        path = os.path.abspath(file_path)
+        entry = WarmTextGrid(tg)
+        with self.lock:
+            self.entries[path] = (key, entry)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def summary(self):
+        return 'TextGrids in memory : {}, {} hit(s), {} miss(es)'.format(
+            len(self.entries), self.hits, self.misses)
 
 
 def one_to_many_pairing(file1, files2, thld=5):
@@ -340,13 +1457,72 @@ def one_to_many_pairing(file1, files2, thld=5):
     return matched
 
 
+# index of file names, to find the match of a name as one_to_many_pairing()
+# does without comparing it with all the names : a name matches only through
+# a common substring longer than thld, so it is compared only with the names
+# sharing one of its (thld + 1)-grams. Once a match of length L is known (a
+# name of the same stem, else a name sharing its rarest gram), the others
+# must contain a substring name[i:i + L], hence the rarest gram of it.
+class FilePairingIndex(object):
+    def __init__(self, files, thld=5):
+        self.files = list(files)
+        self.thld = thld
+        self.q = thld + 1
+        self.names = [f.lower() for f in self.files]
+        self.stems = collections.defaultdict(list)
+        self.postings = collections.defaultdict(list)
+        for k, name in enumerate(self.names):
+            self.stems[os.path.splitext(name)[0]].append(k)
+            for gram in set(name[i:i + self.q]
+                            for i in range(len(name) - self.q + 1)):
+                self.postings[gram].append(k)
+
+    # length of the longest common substring, as in one_to_many_pairing()
+    def match_len(self, file1, name, k):
+        return difflib.SequenceMatcher(None, name, self.names[k]).\
+                find_longest_match(0, len(file1), 0, len(self.files[k]))[2]
+
+    # one_to_many_pairing(file1, self.files, self.thld)
+    def best_match(self, file1):
+        name = file1.lower()
+        q = self.q
+        grams = [name[i:i + q] for i in range(len(name) - q + 1)]
+        counts = [len(self.postings.get(gram, ())) for gram in grams]
+        if not any(counts):
+            return ''
+
+        lengths = {}
+        rarest = min((c, i) for i, c in enumerate(counts) if c)[1]
+        for k in self.stems.get(os.path.splitext(name)[0], []) + \
+                self.postings[grams[rarest]]:
+            if k not in lengths:
+                lengths[k] = self.match_len(file1, name, k)
+        L = max(q, max(lengths.values()))
+        for i in range(len(name) - L + 1):
+            window = counts[i:i + L - q + 1]
+            if min(window):
+                gram = grams[i + window.index(min(window))]
+                for k in self.postings[gram]:
+                    if k not in lengths:
+                        lengths[k] = self.match_len(file1, name, k)
+
+        # don't make a pair if a doublon remains
+        maxlen = max(lengths.values())
+        best = [k for k, match_len in lengths.items() if match_len == maxlen]
+        if maxlen <= self.thld or len(best) > 1:
+            return ''
+        return self.files[best[0]]
+
+
 def make_paires(files1, files2):
     # fine 1-to-1 file pair
+    index1 = FilePairingIndex(files1)
+    index2 = FilePairingIndex(files2)
     pairs = []
     for f1 in files1:
-        f2 = one_to_many_pairing(f1, files2)
+        f2 = index2.best_match(f1)
         if f2:
-            if f1 == one_to_many_pairing(f2, files1):
+            if f1 == index1.best_match(f2):
                 pairs.append((f1, f2))
 
     return pairs
@@ -362,6 +1538,7 @@ def insert_to_basename(filename, inserted, new_ext_name=None):
 
 
 # source : https://stackoverflow.com/questions/2460177/edit-distance-in-python
+# remark: kept as the reference implementation of the distance engines
 def edit_distance(s1, s2):
     m = len(s1) + 1
     n = len(s2) + 1
@@ -380,14 +1557,520 @@ def edit_distance(s1, s2):
     return tbl[i, j]
 
 
+# bit-parallel Levenshtein distance (Myers 1999, global variant by Hyyrö 2001)
+# the columns of the DP table are encoded as bit vectors of len(s1) bits,
+# python integers being unbounded, there is no limit on the length of s1
+def edit_distance_bitparallel(s1, s2):
+    m = len(s1)
+    if not m:
+        return len(s2)
+
+    # bit mask of the positions of each character in s1
+    peq = {}
+    for i, c in enumerate(s1):
+        peq[c] = peq.get(c, 0) | (1 << i)
+
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    pv = mask
+    mv = 0
+    score = m
+    for c in s2:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        # the first row of the table grows by 1 per column (global alignment)
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+
+    return score
+
+
+# distances of s1 to the best matching substring of s2 ending at every
+# position of s2 (semi-global alignment, the start in s2 is free) :
+# dists[j] = min_i edit_distance(s1, s2[i:j]) for j in 0..len(s2)
+def semiglobal_distances(s1, s2):
+    m = len(s1)
+    if not m:
+        return [0] * (len(s2) + 1)
+
+    peq = {}
+    for i, c in enumerate(s1):
+        peq[c] = peq.get(c, 0) | (1 << i)
+
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    pv = mask
+    mv = 0
+    score = m
+    dists = [score]
+    for c in s2:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        # the first row of the table stays at 0 (free start in s2)
+        ph = (ph << 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+        dists.append(score)
+
+    return dists
+
+
+# reference implementation of semiglobal_distances()
+def semiglobal_distances_reference(s1, s2):
+    col = list(range(len(s1) + 1))
+    dists = [col[-1]]
+    for c in s2:
+        new_col = [0]
+        for i in range(1, len(s1) + 1):
+            cost = 0 if s1[i - 1] == c else 1
+            new_col.append(
+                min(new_col[i - 1] + 1, col[i] + 1, col[i - 1] + cost))
+        col = new_col
+        dists.append(col[-1])
+    return dists
+
+
+# row-vectorized Levenshtein distance using numpy
+# the dependency on the left cell in a row is resolved with a cumulative min.
+def edit_distance_numpy(s1, s2):
+    if not s1 or not s2:
+        return max(len(s1), len(s2))
+
+    a = numpy.array([ord(c) for c in s1], dtype=numpy.int64)
+    b = numpy.array([ord(c) for c in s2], dtype=numpy.int64)
+    cols = numpy.arange(len(b) + 1, dtype=numpy.int64)
+    row = cols.copy()
+    for i in range(len(a)):
+        tmp = numpy.empty_like(row)
+        tmp[0] = i + 1
+        # substitution (diagonal) and deletion (above)
+        numpy.minimum(row[:-1] + (b != a[i]), row[1:] + 1, out=tmp[1:])
+        # insertion (left) : row[j] = min_k<=j (tmp[k] + j - k)
+        row = numpy.minimum.accumulate(tmp - cols) + cols
+
+    return int(row[-1])
+
+
+distance_engines = collections.OrderedDict([
+    ('reference', edit_distance),
+    ('bitparallel', edit_distance_bitparallel),
+])
+if numpy_installed:
+    distance_engines['numpy'] = edit_distance_numpy
+
+# engine used by distance(), see set_distance_engine()
+distance_engine = edit_distance_bitparallel
+
+
+def set_distance_engine(name):
+    global distance_engine
+    if name not in distance_engines:
+        raise Exception('Unknown distance engine \'{}\', choose among {}'.format(
+            name, list(distance_engines.keys())))
+    distance_engine = distance_engines[name]
+    distance_memo.clear()
+    deb_print('distance engine set to \'{}\'', name)
+
+
+# check the distance engines against the reference one on random strings
+def check_distance_engines(num_trials=1000, max_len=40, alphabet=u'abcdé #<', seed=0):
+    import random
+    rnd = random.Random(seed)
+    mismatch = 0
+    for trial in range(num_trials):
+        s1 = u''.join(rnd.choice(alphabet) for k in range(rnd.randint(0, max_len)))
+        s2 = u''.join(rnd.choice(alphabet) for k in range(rnd.randint(0, max_len)))
+        ref = edit_distance(s1, s2)
+        for name, engine in distance_engines.items():
+            dist = engine(s1, s2)
+            if dist != ref:
+                err_print(u'engine \'{}\' : d(\'{}\',\'{}\') = {} instead of {}'.format(
+                    name, s1, s2, dist, ref))
+                mismatch += 1
+        if semiglobal_distances(s1, s2) != semiglobal_distances_reference(s1, s2):
+            err_print(u'semi-global distances of (\'{}\',\'{}\') differ'.format(
+                s1, s2))
+            mismatch += 1
+    return mismatch
+
+
+# check that the end search of findTimes keeps the former threshold : on
+# 'abcd' against the tokens 'ab xcd', the best substring 'abxcd' is at
+# distance 1 but the last 4 characters 'bxcd' at distance 2, which stays
+# above the threshold 0.3 * 4 ** 1.1
+def check_find_times_end_metric():
+    tier = pympi.Praat.Tier(0, 2, 'mot', 'IntervalTier')
+    tier.add_interval(0, 1, u'ab')
+    tier.add_interval(1, 2, u'xcd')
+    tmin, tmax, cursor, dist = findTimes([u'abcd'], tier, 0, thld=0.3)
+    if semiglobal_distances(u'abcd', u'abxcd')[-1] != 1 or dist != 2 \
+            or tmin != -1:
+        err_print(u'findTimes end metric : distance {} and start {} instead of '
+                  u'2 and -1'.format(dist, tmin))
+        return 1
+    return 0
+
+
+# check TierBuilder against successive add_interval(check=True) calls of
+# pympi, on W(4,10), X(0,5), Y(1,2) (X is rejected, W and Y are kept) and
+# on random intervals
+def check_tier_builder(num_trials=200, seed=0):
+    import random
+    rnd = random.Random(seed)
+    cases = [[(4, 10), (0, 5), (1, 2)]]
+    for trial in range(num_trials):
+        cases.append([
+            tuple(sorted(rnd.randint(0, 30) for k in range(2)))
+            for k in range(rnd.randint(0, 12))
+        ])
+    mismatch = 0
+    for case in cases:
+        ref = pympi.Praat.Tier(0, 30, 'ref', 'IntervalTier')
+        ref_lines = []
+        for line, (begin, end) in enumerate(case):
+            try:
+                ref.add_interval(begin, end, str(line))
+            except Exception:
+                ref_lines.append(line)
+        tier = ColumnarTier(0, 30, 'new', 'IntervalTier')
+        builder = TierBuilder(tier)
+        for line, (begin, end) in enumerate(case):
+            builder.add_interval(begin, end, str(line), line=line)
+        lines = [line for line, e in builder.commit()]
+        kept = list(tier.get_intervals(sort=True))
+        if lines != ref_lines or kept != sorted(ref.get_intervals()):
+            err_print(u'TierBuilder keeps {} instead of {}'.format(
+                kept, sorted(ref.get_intervals())))
+            mismatch += 1
+    return mismatch
+
+
+# retirer des signes de marcro qui ne sont pas présentes dans le tier de ref.
+macrosyntax_signs = re.compile(r"[\#\&\(\)\[\]\/\|\+\s\<\>]")
+
+
+def normalize(s):
+    return macrosyntax_signs.sub("", s.lower())
+
+
+# the distances computed on a miss of the memo, counted in the metrics
+def distance_miss(s1, s2):
+    metrics.count('distance_misses')
+    metrics.count('dp_cells', len(s1) * len(s2))
+    return distance_engine(s1, s2)
+
+
+def semiglobal_miss(s1, s2):
+    metrics.count('distance_misses')
+    metrics.count('dp_cells', len(s1) * len(s2))
+    return semiglobal_distances(s1, s2)
+
+
+# memo of the distances between normalized strings : the same (sentence,
+# window) pairs come again when a local search is retried globally, when
+# the first sentences scored on a tier are aligned on it, and in the nested
+# windows of identify_prenucleus.py. Bounded LRU caches, keyed by the
+# strings, cleared when the distance engine changes
+class DistanceMemo(object):
+    def __init__(self, max_entries=1 << 14):
+        self.resize(max_entries)
+
+    def resize(self, max_entries):
+        self.max_entries = max_entries
+        # hits and misses of the memos of worker processes
+        self.worker_stats = [0, 0]
+        self.distance = functools.lru_cache(max_entries)(distance_miss)
+        # (the lists of distances are shared, not to be modified)
+        self.semiglobal = functools.lru_cache(max_entries)(semiglobal_miss)
+
+    def clear(self):
+        self.distance.cache_clear()
+        self.semiglobal.cache_clear()
+        self.worker_stats = [0, 0]
+
+    # numbers of hits and misses, those of the workers included
+    def stats(self):
+        info1 = self.distance.cache_info()
+        info2 = self.semiglobal.cache_info()
+        return (info1.hits + info2.hits + self.worker_stats[0],
+                info1.misses + info2.misses + self.worker_stats[1])
+
+    # add the numbers of hits and misses of a worker process
+    def add_stats(self, stats):
+        self.worker_stats[0] += stats[0]
+        self.worker_stats[1] += stats[1]
+
+    # numbers of hits and misses since stats() returned start
+    def stats_since(self, start):
+        hits, misses = self.stats()
+        return hits - start[0], misses - start[1]
+
+    def summary(self):
+        hits, misses = self.stats()
+        return 'distance memo ({} entries) : {} hit(s), {} miss(es), hit ' \
+               'rate {:.1%}'.format(self.max_entries, hits, misses,
+                                    hits / float(max(hits + misses, 1)))
+
+
+distance_memo = DistanceMemo()
+
+
+# distance between two strings already normalized
+def distance_normalized(s1, s2):
+    return distance_memo.distance(s1, s2[:len(s1)])
+
+
 def distance(s1, s2):
+    return distance_normalized(normalize(s1), normalize(s2))
+
+
+# index of a time reference tier, to build once per tier and reuse across
+# findTimes() calls : the normalized text of the window of intervals
+# [n, n + width) is the slice text[offsets[n]:offsets[n + width]]
+class RefTierIndex(object):
+    def __init__(self, tier):
+        self.tier = tier
+        self.name = getattr(tier, 'name', None)
+        if isinstance(tier, ColumnarTier):
+            # raw tokens (used to detect pauses and to display results) and
+            # time arrays, shared with the tier
+            self.begins, self.ends, self.tokens = tier.get_all_columns()
+        else:
+            intvs = tier.get_all_intervals()
+            self.tokens = [intv[-1] for intv in intvs]
+            self.begins = array.array('d', (intv[0] for intv in intvs))
+            if getattr(tier, 'tier_type', 'IntervalTier') == 'TextTier':
+                self.ends = array.array('d', self.begins)
+            else:
+                self.ends = array.array('d', (intv[1] for intv in intvs))
+        # normalized tokens concatenated, and their cumulative char. offsets
+        norm_tokens = [normalize(token) for token in self.tokens]
+        self.text = u''.join(norm_tokens)
+        self.offsets = array.array('l', [0])
+        offset = 0
+        for token in norm_tokens:
+            offset += len(token)
+            self.offsets.append(offset)
+        self.qgram_index = None
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def window_text(self, n, width):
+        end = min(n + width, len(self.tokens))
+        return self.text[self.offsets[n]:self.offsets[end]]
+
+    def window(self, n, width):
+        return ' '.join(self.tokens[n:n + width])
+
+    def get_all_intervals(self):
+        return self.tier.get_all_intervals()
+
+    # q-gram index of the normalized text, built on first use
+    def get_qgram_index(self):
+        if self.qgram_index is None:
+            self.qgram_index = QGramIndex(self)
+        return self.qgram_index
+
+    # intervals within [tmin, tmax]
+    def view(self, tmin, tmax):
+        return RefTierView(self, tmin, tmax)
+
+
+# read-only view of the items [lo, hi) of a list
+class ListView(object):
+    __slots__ = ('items', 'lo', 'hi')
+
+    def __init__(self, items, lo, hi):
+        self.items = items
+        self.lo = lo
+        self.hi = hi
+
+    def __len__(self):
+        return self.hi - self.lo
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return [self.items[k] for k in range(self.lo, self.hi)[n]]
+        if n < 0:
+            n += self.hi - self.lo
+        if not 0 <= n < self.hi - self.lo:
+            raise IndexError('index out of range')
+        return self.items[self.lo + n]
+
+    def __iter__(self):
+        return itertools.islice(self.items, self.lo, self.hi)
+
+
+# view of the intervals of a RefTierIndex within [tmin, tmax], located by
+# bisection : the index is shared, nothing is copied. It stands for the
+# RefTierIndex of the intervals within [tmin, tmax] in findTimes()
+class RefTierView(RefTierIndex):
+    def __init__(self, index, tmin, tmax):
+        self.tier = index.tier
+        self.name = index.name
+        lo = bisect.bisect_left(index.begins, tmin)
+        hi = max(lo, bisect.bisect_right(index.ends, tmax))
+        self.lo, self.hi = lo, hi
+        self.tokens = ListView(index.tokens, lo, hi)
+        self.begins = memoryview(index.begins)[lo:hi]
+        self.ends = memoryview(index.ends)[lo:hi]
+        # (the offsets are those of the whole text)
+        self.text = index.text
+        self.offsets = memoryview(index.offsets)[lo:hi + 1]
+        self.qgram_index = None
+
+    def get_all_intervals(self):
+        if getattr(self.tier, 'tier_type', 'IntervalTier') == 'TextTier':
+            return list(zip(self.begins, self.tokens))
+        return list(zip(self.begins, self.ends, self.tokens))
+
+    def get_qgram_index(self):
+        raise Exception('No q-gram index for a view of a ref. tier')
+
+
+# inverted index of the q-grams of the normalized text of a ref. tier, to
+# short-list the intervals where a sentence may begin : each of the rarest
+# q-grams of the sentence (at offset p) found in the text (at offset t) votes
+# for the interval containing the char. t - p
+class QGramIndex(object):
+    def __init__(self, ref, q=3, num_grams=32):
+        t0 = time.time()
+        self.ref = ref
+        self.q = q
+        # number of q-grams of a sentence used to vote
+        self.num_grams = num_grams
+        postings = collections.defaultdict(lambda: array.array('l'))
+        text = ref.text
+        for t in range(len(text) - q + 1):
+            postings[text[t:t + q]].append(t)
+        self.postings = dict(postings)
+        # index of the interval containing each char. of the text
+        self.intervals_of_chars = array.array('l')
+        for n in range(len(ref)):
+            self.intervals_of_chars.extend(
+                [n] * (ref.offsets[n + 1] - ref.offsets[n]))
+        self.build_time = time.time() - t0
+        # statistics
+        self.num_queries = 0
+        self.num_hits = 0
+        self.num_candidates = 0
+
+    # return the indexes of the intervals where the (normalized) sentence
+    # most likely begins, or None if the sentence is too short to be indexed
+    def candidates(self, sent_norm, num_candidates=20, spread=1):
+        q = self.q
+        if len(sent_norm) < q or not self.intervals_of_chars:
+            return None
+        # the rarest q-grams of the sentence present in the text
+        grams = []
+        for p in range(len(sent_norm) - q + 1):
+            positions = self.postings.get(sent_norm[p:p + q])
+            if positions:
+                grams.append((len(positions), p, positions))
+        grams.sort()
+        votes = collections.Counter()
+        intervals_of_chars = self.intervals_of_chars
+        for num_positions, p, positions in grams[:self.num_grams]:
+            votes.update(intervals_of_chars[t - p] if t >= p else 0
+                         for t in positions)
+        # best voted intervals and their neighbours
+        num_intervals = len(self.ref)
+        candidates = set()
+        for n, vote in votes.most_common(num_candidates):
+            for k in range(max(n - spread, 0),
+                           min(n + spread + 1, num_intervals)):
+                candidates.add(k)
+        return sorted(candidates)
+
+    # findTimes() on the whole ref. tier, restricted to the candidates of the
+    # sentence which can start it (neither pauses nor empty intervals). The
+    # statistics count only the searches on such a short-list, and the
+    # sentences found by them : without any, the whole tier is scanned.
+    def search(self, tokens, thld=0.05, pauseSign='#'):
+        ref_tokens = self.ref.tokens
+        candidates = [
+            n for n in self.candidates(normalize(' '.join(tokens))) or []
+            if ref_tokens[n] != pauseSign and ref_tokens[n]
+        ]
+        if not candidates:
+            return findTimes(tokens, self.ref, lowerbound=0, upperbound=-1,
+                             thld=thld, pauseSign=pauseSign)
+        self.num_queries += 1
+        self.num_candidates += len(candidates)
+        result = findTimes(tokens, self.ref, lowerbound=0, upperbound=-1,
+                           thld=thld, pauseSign=pauseSign,
+                           candidates=candidates)
+        if result[2] >= 0:
+            self.num_hits += 1
+        return result
+
+    def summary(self):
+        return u'q-gram index of \'{}\' : built in {:.3f}s, {} queries, ' \
+               u'{:.1f} candidates / query, hit rate {:.1%}'.format(
+                   self.ref.name, self.build_time, self.num_queries,
+                   self.num_candidates / float(max(self.num_queries, 1)),
+                   self.num_hits / float(max(self.num_queries, 1)))
+
+
+# cheap elimination of the tiers which can not be the time reference tier of
+# a transcription : wrong tier type, too few intervals compared with the
+# number of tokens, or too small vocabulary overlap with the tokens sampled.
+# return the names of the remaining tiers, the most overlapping first
+def prefilter_ref_tiers(tg,
+                        tierNames,
+                        sampled_tokens,
+                        num_tokens,
+                        pauseSign='#',
+                        min_overlap=0.3,
+                        min_intervals_ratio=0.5):
+    vocabulary = set(normalize(token) for token in sampled_tokens)
+    vocabulary.discard('')
+    num_tokens = len([1 for token in sampled_tokens if normalize(token)]) \
+        if num_tokens is None else num_tokens
+
+    overlaps = []
+    for tierName in tierNames:
+        tier = tg.get_tier(tierName)
+        if tier.tier_type != 'IntervalTier':
+            deb_print(u'{} eliminated : {}', tierName, tier.tier_type)
+            continue
+        tier_tokens = [
+            intv[-1] for intv in tier.get_intervals()
+            if intv[-1].strip() and intv[-1].strip() != pauseSign
+        ]
+        if len(tier_tokens) < min_intervals_ratio * num_tokens:
+            deb_print(u'{} eliminated : {} intervals for {} tokens', tierName,
+                      len(tier_tokens), num_tokens)
+            continue
+        tier_vocabulary = set(normalize(token) for token in tier_tokens)
+        overlap = len(vocabulary & tier_vocabulary) / float(
+            max(len(vocabulary), 1))
+        if overlap < min_overlap:
+            deb_print(u'{} eliminated : vocabulary overlap {:.2f}', tierName,
+                      overlap)
+            continue
+        overlaps.append((overlap, tierName))
 
-    # retirer des signes de marcro qui ne sont pas présentes dans le tier de ref.
-    macrosyntax_signs = re.compile(r"[\#\&\(\)\[\]\/\|\+\s\<\>]")
-    s1 = re.sub(macrosyntax_signs, "", s1.lower())
-    s2 = re.sub(macrosyntax_signs, "", s2.lower())
-    dist = edit_distance(s1, s2[:len(s1)])
-    return dist
+    return [tierName for overlap, tierName in
+            sorted(overlaps, key=lambda x: -x[0])]
 
 
 def findTimes(tokens,
@@ -395,73 +2078,210 @@ def findTimes(tokens,
               lowerbound,
               upperbound=-1,
               thld=0.1,
-              pauseSign='#'):
+              pauseSign='#',
+              candidates=None):
 
     sent = ' '.join(tokens)
-    intvs = refTier.get_all_intervals()
-    ref_tokens = [intv[-1] for intv in intvs]
+    sent_norm = normalize(sent)
+    # refTier is either a RefTierIndex or a tier to index
+    if not isinstance(refTier, RefTierIndex):
+        refTier = RefTierIndex(refTier)
+    ref_tokens = refTier.tokens
     best_dist = -1
     best_begin_n = -1
     best_end_n = -1
-    ref_tokens_sampled = []
-    best_begin_ref_sent = ''
-    best_end_ref_sent = ''
     width = 2 * len(tokens)
 
     # détection du début temporel
     if upperbound < 0:  # interprete negative upper bound as unbounded case
         upperbound = len(ref_tokens)
-    for n in range(lowerbound, upperbound)[::-1]:
-        # check if n is correct
-        try:
-            ref_tokens[n]
-        except IndexError:
-            continue
-        # adapt real width if necessary
-        try:
-            ref_tokens_sampled = ref_tokens[n:n + width]
-        except IndexError:
-            ref_tokens_sampled = ref_tokens[n:]
+    upperbound = min(upperbound, len(ref_tokens))
+    positions = range(lowerbound, upperbound)
+    # restrict the search to a short-list of positions if any, or scan the
+    # whole range if none of them can start the sentence
+    if candidates is not None:
+        shortlist = [
+            n for n in candidates if lowerbound <= n < upperbound and
+            ref_tokens[n] != pauseSign and ref_tokens[n]
+        ]
+        if shortlist:
+            positions = shortlist
+    lookups = 1  # distances asked to the memo
+    for n in positions[::-1]:
         # check if the current token represnts a pause
         if ref_tokens[n] == pauseSign or not (ref_tokens[n]):
             continue  # interdiction d'aligner le début de la phrase sur une pause ou un vide
 
         # search the begining
-        ref_sent = ' '.join(ref_tokens_sampled)
-        dist = distance(sent, ref_sent)
+        dist = distance_normalized(sent_norm, refTier.window_text(n, width))
+        lookups += 1
         if best_dist < 0 or dist <= best_dist:
             best_dist = dist
             best_begin_n = n
-            best_begin_ref_sent = ref_sent
 
-    tmin = intvs[best_begin_n][0]  # begining time of the starting interval
+    # no interval to start the sentence on : the search fails
+    if best_begin_n < 0:
+        metrics.count('findTimes_calls')
+        metrics.count('distance_lookups', lookups - 1)
+        deb_print(u"\t@findTimes err : no start in [{}, {})", lowerbound,
+                  upperbound)
+        return [-1, -1, -1, len(sent_norm)]
+
+    tmin = refTier.begins[best_begin_n]  # begining time of the starting interval
 
     # détection de la vraie fin temporelle
-    best_dist = -1
-    best_sent = ''
+    # in one pass, get the distance of the sentence to the best substring
+    # of the window ending at each char., then read it at each token end
     width = 2 * len(tokens)
+    start = refTier.offsets[best_begin_n]
+    dists = distance_memo.semiglobal(sent_norm,
+                                     refTier.window_text(best_begin_n, width))
+    metrics.count('findTimes_calls')
+    metrics.count('distance_lookups', lookups)
+    best_dist = -1
     while width:
         end_n = best_begin_n + width
-        ref_sent = ' '.join(ref_tokens[best_begin_n:end_n])
-        dist = distance(sent[::-1], ref_sent[::-1])
+        end = refTier.offsets[min(end_n, len(ref_tokens))] - start
+        dist = dists[max(end, 0)]
         if best_dist < 0 or dist <= best_dist:
             best_dist = dist
             best_end_n = end_n
-            best_sent = ref_sent
         width -= 1
 
+    # the semi-global distance only chooses the end : the distance checked
+    # and returned is still that of the window cut to the sentence length
+    # before its end, as with the former per-width search
+    end = refTier.offsets[min(best_end_n, len(ref_tokens))] - start
+    head = refTier.text[start:start + max(end, 0)]
+    best_dist = distance_normalized(sent_norm[::-1], head[::-1])
+
     # verify if dist < 10% of sentence length
-    deb_print(u"\t@findTimes sent to match : '{}'".format(sent))
+    deb_print(u"\t@findTimes sent to match : '{}'", sent)
     if best_dist > thld * (len(sent)**1.1):
         tmin = -1
         tmax = -1
         cursor_out = -1
-        deb_print(
-            u"\t@findTimes err : best dist. '{}' too large".format(best_dist))
+        deb_print(u"\t@findTimes err : best dist. '{}' too large", best_dist)
     else:
-        tmax = intvs[best_end_n - 1][1]  # end time of the last interval
+        tmax = refTier.ends[best_end_n - 1]  # end time of the last interval
         cursor_out = best_end_n
-        deb_print(u"\t@findTimes sent found    : '{}'".format(
-            best_sent, tmin, tmax))
+        if DEBUG_EN:
+            deb_print(u"\t@findTimes sent found    : '{}'",
+                      refTier.window(best_begin_n, best_end_n - best_begin_n))
 
     return [tmin, tmax, cursor_out, best_dist]
+
+
+
+# monotone alignment of two token sequences in one banded DP pass
+# (token level DTW with gaps) : tokens1[i] may be matched with tokens2[j]
+# only if |j - i * len(tokens2) / len(tokens1)| <= band. Skipping the
+# tokens of tokens2 before the first match and after the last match is
+# free, skipping any other token of tokens2 costs skip (fillers of the ref.
+# tier are not in CoNLL).
+# The forward pass keeps two rows of costs plus one row every
+# sqrt(len(tokens1)) rows. The traceback recomputes the rows of one such
+# segment at a time with their backpointers (one byte per cell), so the
+# memory is O(sqrt(len(tokens1)) * band) for twice the DP cells, plus the
+# token distances kept by the memo, bounded by its size (--distance-memo).
+# return for each token of tokens1 the index of its matched token in
+# tokens2 or -1 and the total cost of the alignment, all -1 and an
+# infinite cost if the band is too narrow to link both ends
+def align_tokens_banded(tokens1, tokens2, band=100, gap=1.0, skip=0.5):
+    n1 = len(tokens1)
+    n2 = len(tokens2)
+    matches = [-1] * n1
+    if not n1 or not n2:
+        return matches, float(n1) * gap
+
+    # substitution cost between 2 tokens in [0,1], the distances being kept
+    # in the bounded memo of the distances (see DistanceMemo)
+    def sub_cost(a, b):
+        if a == b:
+            return 0.0
+        return distance_memo.distance(a, b) / float(max(len(a), len(b)))
+
+    DIAG, UP, LEFT = 0, 1, 2
+    inf = float('inf')
+    ratio = n2 / float(n1)
+    cells = [0]
+
+    # row i of costs (and its backpointers) from row i-1
+    def next_row(i, prev, prev_lo):
+        center = int(round(i * ratio))
+        lo = max(0, center - band)
+        hi = min(n2, center + band)
+        prev_hi = prev_lo + len(prev) - 1
+        row = [inf] * (hi - lo + 1)
+        ptr = bytearray(hi - lo + 1)
+        a = tokens1[i - 1]
+        for j in range(lo, hi + 1):
+            # skip tokens1[i-1]
+            best = prev[j - prev_lo] + gap if prev_lo <= j <= prev_hi else inf
+            move = UP
+            if j > lo:
+                # skip tokens2[j-1]
+                cost = row[j - 1 - lo] + skip
+                if cost < best:
+                    best, move = cost, LEFT
+            if j > 0 and prev_lo <= j - 1 <= prev_hi:
+                # match tokens1[i-1] with tokens2[j-1]
+                cost = prev[j - 1 - prev_lo] + sub_cost(a, tokens2[j - 1])
+                if cost <= best:
+                    best, move = cost, DIAG
+            row[j - lo] = best
+            ptr[j - lo] = move
+        cells[0] += hi - lo + 1
+        return row, lo, ptr
+
+    # first row : free skip of the leading tokens of tokens2
+    prev = [0.0] * (min(n2, band) + 1)
+    prev_lo = 0
+    step = max(1, int(n1**0.5))
+    checkpoints = [(prev, prev_lo)]
+    for i in range(1, n1 + 1):
+        prev, prev_lo, ptr = next_row(i, prev, prev_lo)
+        if i % step == 0:
+            checkpoints.append((prev, prev_lo))
+
+    # free skip of the trailing tokens of tokens2
+    # (on equality, prefer the alignment which goes the furthest in tokens2)
+    best_cost = min(prev)
+    if best_cost == inf:
+        metrics.count('dp_cells', cells[0])
+        return matches, best_cost
+    j = prev_lo + len(prev) - 1 - prev[::-1].index(best_cost)
+
+    # traceback, one segment of rows (first, i] at a time
+    i = n1
+    while i > 0:
+        first = (i - 1) // step * step
+        row, lo = checkpoints[first // step]
+        los = []
+        pointers = []
+        for k in range(first + 1, i + 1):
+            row, lo, ptr = next_row(k, row, lo)
+            los.append(lo)
+            pointers.append(ptr)
+        while i > first:
+            move = pointers[i - first - 1][j - los[i - first - 1]]
+            if move == DIAG:
+                matches[i - 1] = j - 1
+                i -= 1
+                j -= 1
+            elif move == UP:
+                i -= 1
+            else:
+                j -= 1
+
+    metrics.count('dp_cells', cells[0])
+    return matches, best_cost
+
+if __name__ == '__main__':
+    # self-check of the distance engines
+    num_err = check_distance_engines()
+    info_print('distance engines {} : {} mismatch(es)'.format(
+        list(distance_engines.keys()), num_err))
+    num_err += check_find_times_end_metric()
+    num_err += check_tier_builder()
+    sys.exit(1 if num_err else 0)
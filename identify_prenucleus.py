@@ -20,6 +20,11 @@ def core_routine(sents, srcCol, pauseSign, dest, ref, num_sent_to_read=-1):
     cursor = 0
     err_num = 0
     dist_tot = 0
+    # index the ref. tier once for all the sentences
+    if not isinstance(ref, RefTierIndex):
+        ref = RefTierIndex(ref)
+    # the intervals are added to the dest. tier at the end, at once
+    builder = TierBuilder(dest)
 
     for n, sent in enumerate(sents):
         # try a local search from cursor to end of time with by default thld.
@@ -32,39 +37,28 @@ def core_routine(sents, srcCol, pauseSign, dest, ref, num_sent_to_read=-1):
                                                         pauseSign=pauseSign)
         if cursor_out >= cursor:
             cursor = cursor_out
-            deb_print("L{} local (begin,end) = ({:8.3f},{:8.3f})".format(
-                n, begin, end))
+            deb_print("L{} local (begin,end) = ({:8.3f},{:8.3f})", n, begin,
+                      end)
 
             # écrire le contenu dans le tier de destination
-            try:
-                dest.add_interval(begin=begin, end=end, value=sent, check=True)
-            except Exception as e:
-                err_print(u"Line {} @ CoNLL : {}".format(n, e))
-                err_num += 1
+            builder.add_interval(begin, end, sent, line=n)
 
         else:
             # try a global search but with a more strict threshold for distance
+            # on the positions short-listed by the q-gram index of the ref. tier
+            metrics.count('global_fallbacks')
             [begin, end, cursor_out,
-             best_dist] = findTimes(tokens,
-                                    ref,
-                                    lowerbound=0,
-                                    upperbound=-1,
-                                    thld=0.05,
-                                    pauseSign=pauseSign)
+             best_dist] = ref.get_qgram_index().search(tokens,
+                                                       thld=0.05,
+                                                       pauseSign=pauseSign)
             if cursor_out >= 0:
                 # écrire le contenu dans le tier de destination
-                try:
-                    dest.add_interval(begin=begin,
-                                      end=end,
-                                      value=sent,
-                                      check=True)
-                    deb_print("Line {} global (begin,end) = ({:8.3f},{:8.3f})".
-                              format(n, begin, end))
-                except Exception as e:
-                    err_print(u"Line {} @ CoNLL : {}".format(n, e))
-                    err_num += 1
+                builder.add_interval(begin, end, sent, line=n)
+                deb_print("Line {} global (begin,end) = ({:8.3f},{:8.3f})", n,
+                          begin, end)
             else:
                 err_print("Search fails @ Line {} of the CoNLL".format(n))
+                metrics.count('failed_sentences')
                 err_num += 1
 
         # early break if number of sentences to read is reached
@@ -75,6 +69,13 @@ def core_routine(sents, srcCol, pauseSign, dest, ref, num_sent_to_read=-1):
         sentId += 1
         tokens = []
 
+    # overlaps are checked in one pass
+    for line, e in builder.commit():
+        err_print(u"Line {} @ CoNLL : {}".format(line, e))
+        err_num += 1
+
+    if ref.qgram_index is not None:
+        info_print(ref.qgram_index.summary())
     return err_num, dist_tot
 
 
@@ -131,6 +132,109 @@ def detect_ref_tier(tg,
     """
 
 
+# detection of the time reference tier of a TextGrid holding the tier of the
+# transcription txTierName
+def find_ref_tier(tg, txTierName='tx_new'):
+    tx = tg.get_tier(txTierName)
+    avaliableTierNames = [
+        t.name for t in tg.get_tiers()
+        if t.name != 'tx' and t.name != txTierName
+    ]
+    sents = [interval[-1] for interval in tx.get_all_intervals()]
+    best_ref_name, best_dist = detect_ref_tier(
+        tg,
+        sents,
+        srcCol=2,
+        pauseSign="#",
+        destTierName=txTierName,
+        avaliableTierNames=avaliableTierNames,
+        num_sent_to_read=10)
+    info_print('Set \'{}\' as time reference tier'.format(best_ref_name))
+    return best_ref_name
+
+
+# add the tiers prenucleus_ic_key and prenucleus_ic_value of the
+# illocutionary components of the prenuclei of the transcription txTierName,
+# refTier being the RefTierIndex of the time reference tier
+def add_prenucleus_tiers(tg, refTier, txTierName='tx_new'):
+    tx = tg.get_tier(txTierName)
+    prenucleus_ic_id = tg.add_tier('prenucleus_ic_key')
+    prenucleus_ic_value = tg.add_tier('prenucleus_ic_value')
+    all_IC_intervals = []
+
+    for interval in tx.get_all_intervals():
+        tmin_sent, tmax_sent, sent = interval
+        if sent:
+            # segment sentence in illocutionrary units
+            # using as delimiters
+            # typical boundaries between IUs '//'
+            # boudaries of parralled IUs '//+'
+            # boundaries of reported speech ' [ ' and ' ] '
+            IUs = re.split('//\+|//\=|//|\[|\]', sent)
+            IUs = [IU for IU in IUs if IU.strip()]
+            for n, IU in enumerate(IUs):
+
+                # identify prenucleus and extract illocutionrary compoents
+                IC_intervals = []
+                if ' < ' in IU:
+                    # identify the temporal limits of IU
+                    # inside the temporal limits of sentence
+                    ref = refTier.view(tmin_sent, tmax_sent)
+                    tokens = IU.split(' ')
+                    [tmin_IU, tmax_IU, cursor_out,
+                     best_dist] = findTimes(tokens=tokens,
+                                            refTier=ref,
+                                            lowerbound=0,
+                                            upperbound=-1,
+                                            thld=1000,
+                                            pauseSign="#")
+                    #print(tmin_IU, tmax_IU)
+                    # (no interval of the ref. tier to align the IU on)
+                    if cursor_out < 0:
+                        err_print(u"IU '{}' not found in ({},{})".format(
+                            IU.strip(), tmin_sent, tmax_sent))
+                        continue
+                    ICs = IU.split('<')[:-1]
+                    cursor = 0
+                    for IC in ICs:
+                        IC = IC.strip()
+                        if IC:
+                            ref = refTier.view(tmin_IU, tmax_IU)
+                            tokens = IC.split(' ')
+                            [tmin_IC, tmax_IC, cursor_out,
+                             best_dist] = findTimes(tokens=tokens,
+                                                    refTier=ref,
+                                                    lowerbound=cursor,
+                                                    upperbound=-1,
+                                                    thld=1000,
+                                                    pauseSign="#")
+                            if cursor_out < 0:
+                                err_print(u"IC '{}' not found in ({},{})".
+                                          format(IC, tmin_IU, tmax_IU))
+                                continue
+                            cursor = cursor_out
+                            IC_intervals.append((tmin_IC, tmax_IC, IC))
+
+                if IC_intervals:
+                    all_IC_intervals.append(IC_intervals)
+
+    prenucleus_ic_id_builder = TierBuilder(prenucleus_ic_id)
+    prenucleus_ic_value_builder = TierBuilder(prenucleus_ic_value)
+    for k, ICs_of_IU in enumerate(all_IC_intervals):
+        for n, IC_interval in enumerate(ICs_of_IU):
+            tmin, tmax, IC = IC_interval
+            print("{}.{}, ({},{}), '{}".format(k, n, tmin, tmax, IC))
+            prenucleus_ic_id_builder.add_interval(
+                tmin, tmax, '{}:{}'.format(k, n), line=(k, n))
+            prenucleus_ic_value_builder.add_interval(tmin, tmax, IC,
+                                                     line=(k, n))
+    # (the two tiers hold the same intervals)
+    prenucleus_ic_value_builder.commit()
+    for (k, n), e in prenucleus_ic_id_builder.commit():
+        err_print(u"IC {}.{} : {}".format(k, n, e))
+    return all_IC_intervals
+
+
 from exporter_lib import *
 
 if __name__ == '__main__':
@@ -141,18 +245,39 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='identifier un ensemble ordonné des intervalles temporelles étiquetées aux composants illocutoires (CI) à chacun des *prénoyeaux* la transcription reportée en tant que la tire tx_new.')
     parser.add_argument('praat_in', help='path to a input folder or a single input file')
     parser.add_argument('praat_out', help='path to output folder')
+    parser.add_argument('--cache-dir',
+                        help='folder of a cache of the parsed TextGrids '
+                        '(default: no cache)')
+    parser.add_argument('--cache-size',
+                        type=int,
+                        default=1024,
+                        help='maximum size in MB of the cache (default: 1024)')
+    parser.add_argument('--distance-memo',
+                        type=int,
+                        default=1 << 14,
+                        help='number of distances kept in memory by kind '
+                        '(default: 16384)')
     args = parser.parse_args()
+    distance_memo.resize(args.distance_memo)
 
     # output folder to create if not exists
     if not os.path.exists(args.praat_out):
         os.makedirs(args.praat_out)
+    # encodings detected in the previous runs
+    set_encoding_cache(os.path.join(args.praat_out, '.encodings.json'))
+    tg_cache = None
+    if args.cache_dir:
+        tg_cache = TextGridCache(args.cache_dir, args.cache_size << 20)
 
     # input file paths
     infile_paths = []
     if os.path.isfile(args.praat_in):
         infile_paths = [args.praat_in]
+        # ref. tiers chosen by the exporter
+        recorded_ref_tiers = load_ref_tiers(os.path.dirname(args.praat_in))
     elif os.path.isdir(args.praat_in):
-        infile_paths = [os.path.join(args.praat_in,infile) for infile in os.listdir(args.praat_in)]
+        infile_paths = [os.path.join(args.praat_in,infile) for infile in os.listdir(args.praat_in) if not infile.startswith('.')]
+        recorded_ref_tiers = load_ref_tiers(args.praat_in)
 
     for infile_path in infile_paths:
         try:
@@ -161,105 +286,26 @@ if __name__ == '__main__':
 
             encoding = get_encoding(infile_path)
             txTierName = 'tx_new'
-            tg = TextGridPlus(file_path=infile_path,
-                              codec=encoding,
-                              analorFileEn=javaobj_installed)
-            tx = tg.get_tier(txTierName)
-            avaliableTierNames = [
-                t.name for t in tg.get_tiers()
-                if t.name != 'tx' and t.name != txTierName
-            ]
-            tg.add_tier('prenucleus_ic_key')
-            tg.add_tier('prenucleus_ic_value')
-            prenucleus_ic_id = tg.get_tier('prenucleus_ic_key')
-            prenucleus_ic_value = tg.get_tier('prenucleus_ic_value')
-
-            sents = [interval[-1] for interval in tx.get_all_intervals()]
-            all_IC_intervals = []
-
-            best_ref_name, best_dist = detect_ref_tier(
-                tg,
-                sents,
-                srcCol=2,
-                pauseSign="#",
-                destTierName=txTierName,
-                avaliableTierNames=avaliableTierNames,
-                num_sent_to_read=10)
-            info_print(
-                'Set \'{}\' as time reference tier'.format(best_ref_name))
-
-            refTier = tg.get_tier(best_ref_name)
-
-            class subRefTier:
-                def __init__(self, tier, tmin, tmax):
-                    all_intervals = tier.get_all_intervals()
-                    self.intervals = [
-                        interval for interval in all_intervals
-                        if interval[0] >= tmin and interval[1] <= tmax
-                    ]
-
-                def get_all_intervals(self):
-                    return self.intervals
-
-            for interval in tx.get_all_intervals():
-                tmin_sent, tmax_sent, sent = interval
-                if sent:
-                    # segment sentence in illocutionrary units
-                    # using as delimiters
-                    # typical boundaries between IUs '//'
-                    # boudaries of parralled IUs '//+'
-                    # boundaries of reported speech ' [ ' and ' ] '
-                    IUs = re.split('//\+|//\=|//|\[|\]', sent)
-                    IUs = [IU for IU in IUs if IU.strip()]
-                    for n, IU in enumerate(IUs):
-
-                        # identify prenucleus and extract illocutionrary compoents
-                        IC_intervals = []
-                        if ' < ' in IU:
-                            # identify the temporal limits of IU
-                            # inside the temporal limits of sentence
-                            ref = subRefTier(refTier, tmin_sent, tmax_sent)
-                            tokens = IU.split(' ')
-                            [tmin_IU, tmax_IU, cursor_out,
-                             best_dist] = findTimes(tokens=tokens,
-                                                    refTier=ref,
-                                                    lowerbound=0,
-                                                    upperbound=-1,
-                                                    thld=1000,
-                                                    pauseSign="#")
-                            #print(tmin_IU, tmax_IU)
-                            ICs = IU.split('<')[:-1]
-                            cursor = 0
-                            for IC in ICs:
-                                IC = IC.strip()
-                                if IC:
-                                    ref = subRefTier(refTier, tmin_IU, tmax_IU)
-                                    tokens = IC.split(' ')
-                                    [tmin_IC, tmax_IC, cursor,
-                                     best_dist] = findTimes(tokens=tokens,
-                                                            refTier=ref,
-                                                            lowerbound=cursor,
-                                                            upperbound=-1,
-                                                            thld=1000,
-                                                            pauseSign="#")
-                                    IC_intervals.append((tmin_IC, tmax_IC, IC))
-
-                        if IC_intervals:
-                            all_IC_intervals.append(IC_intervals)
-
-            for k, ICs_of_IU in enumerate(all_IC_intervals):
-                for n, IC_interval in enumerate(ICs_of_IU):
-                    tmin, tmax, IC = IC_interval
-                    print("{}.{}, ({},{}), '{}".format(k, n, tmin, tmax, IC))
-                    prenucleus_ic_id.add_interval(begin=tmin,
-                                                  end=tmax,
-                                                  value='{}:{}'.format(k, n),
-                                                  check=True)
-                    prenucleus_ic_value.add_interval(begin=tmin,
-                                                     end=tmax,
-                                                     value=IC,
-                                                     check=True)
+            tg = load_textgrid(infile_path,
+                               codec=encoding,
+                               analorFileEn=javaobj_installed,
+                               cache=tg_cache)
+            ref_name = recorded_ref_tiers.get(os.path.basename(infile_path))
+            if ref_name in [t.name for t in tg.get_tiers()]:
+                info_print('Use \'{}\' as time reference tier (recorded by '
+                           'the exporter)'.format(ref_name))
+            else:
+                ref_name = find_ref_tier(tg, txTierName)
+            # index the ref. tier once, then search in views of its time
+            # windows
+            add_prenucleus_tiers(tg, RefTierIndex(tg.get_tier(ref_name)),
+                                 txTierName)
             print('{} -> {}'.format(infile_path, outfile_path))
             tg.to_file(filepath=outfile_path, codec='utf-8', mode='binary')
         except Exception as e:
             print(e)
+
+    save_encoding_cache()
+    if tg_cache:
+        info_print(tg_cache.summary())
+    info_print(distance_memo.summary())
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# synthetic corpus of paired CoNLL-U / TextGrid files, for benchmarks
+# prerequisite : pympi.Praat
+#
+# usage : python make_corpus.py folder [--files N] [--sentences N] [--tiers N]
+#             [--pauses P] [--noise P] [--reorder P] [--formats F,F,..]
+#
+# folder/conll/corpus_K.conll is paired with folder/<format>/corpus_K.TextGrid
+# (corpus_K.Collection) for each of the formats :
+#     text       : long text TextGrid
+#     short      : short text TextGrid
+#     binary     : binary TextGrid
+#     collection : binary Praat Collection of a Sound and of the TextGrid
+
+import os, argparse, random, struct, pympi.Praat
+
+formats = ['text', 'short', 'binary', 'collection']
+
+vocabulary = (u'le la les un une des de du et à en il elle on nous vous ils '
+              u'chat chien maison jardin été très bien alors donc euh ben '
+              u'mange voit dit fait petit grand rouge bleu après déjà là où '
+              u'ça être avoir aller venir français hôpital forêt naïf').split()
+
+# macrosyntax signs of the CoNLL transcriptions
+macrosyntax = [u'//', u'<', u'//+', u'[', u']', u'(', u')', u'&']
+
+# names of the tiers after the ref. tier 'mot' and the sentence tier 'tx'
+extra_tier_names = [u'phones', u'syll', u'locuteur', u'comment']
+
+
+# orthographic noise on a token of the CoNLL : case, accents, typos
+def noisy(token, rnd):
+    kind = rnd.randrange(4)
+    if kind == 0:
+        return token.upper()
+    if kind == 1:
+        return token.replace(u'é', u'e').replace(u'à', u'a').replace(
+            u'ô', u'o').replace(u'ç', u'c')
+    k = rnd.randrange(len(token))
+    if kind == 2:  # substitution
+        return token[:k] + rnd.choice(u'aeiourst') + token[k + 1:]
+    return token[:k] + token[k + 1:] or token  # deletion
+
+
+# sentences of (token, duration) : '#' stands for a pause
+def make_sentences(num_sentences, pause_density, rnd, min_len=2, max_len=25):
+    sents = []
+    for n in range(num_sentences):
+        sent = []
+        for k in range(rnd.randint(min_len, max_len)):
+            if k and rnd.random() < pause_density:
+                sent.append((u'#', rnd.uniform(0.2, 0.8)))
+            else:
+                sent.append((rnd.choice(vocabulary), rnd.uniform(0.1, 0.4)))
+        sents.append(sent)
+    return sents
+
+
+# TextGrid of the sentences : tiers 'mot' (one interval per token), 'tx' (one
+# interval per sentence) then up to num_tiers tiers
+def make_textgrid(sents, num_tiers, rnd):
+    xmax = sum(d for sent in sents for token, d in sent)
+    tg = pympi.Praat.TextGrid(xmax=xmax)
+    mot = tg.add_tier(u'mot')
+    tx = tg.add_tier(u'tx')
+    extra = [
+        tg.add_tier(extra_tier_names[k] if k < len(extra_tier_names) else
+                    u'tier{}'.format(k + 3))
+        for k in range(max(num_tiers - 2, 0))
+    ]
+    t = 0.0
+    for n, sent in enumerate(sents):
+        t0 = t
+        for token, d in sent:
+            mot.add_interval(t, t + d, token, check=False)
+            # a finer tier (of phones), then coarser ones
+            if extra:
+                extra[0].add_interval(t, t + d / 2, token[:1], check=False)
+                extra[0].add_interval(t + d / 2, t + d, token[1:], check=False)
+            t += d
+        tx.add_interval(t0, t, u' '.join(token for token, d in sent),
+                        check=False)
+        for tier in extra[1:]:
+            tier.add_interval(t0, t, u'S{}'.format(n), check=False)
+    # last interval ends exactly at xmax
+    for tier in tg.tiers:
+        tier.xmin, tier.xmax = 0.0, t
+    tg.xmax = t
+    return tg
+
+
+# CoNLL-U lines of the sentences, with macrosyntax signs, orthographic noise
+# and a ratio of sentences swapped with the next one
+def make_conll(sents, noise, reorder, rnd):
+    order = list(range(len(sents)))
+    for n in range(len(order) - 1):
+        if rnd.random() < reorder:
+            order[n], order[n + 1] = order[n + 1], order[n]
+    lines = []
+    for n in order:
+        tokens = [token for token, d in sents[n]]
+        if len(tokens) > 4 and rnd.random() < 0.5:
+            tokens.insert(rnd.randint(1, len(tokens) - 2), u'<')
+        if rnd.random() < 0.5:
+            tokens.append(rnd.choice(macrosyntax))
+        lines.append(u'# sent_id = {}'.format(n))
+        lines.append(u'# text = {}'.format(u' '.join(tokens)))
+        for k, token in enumerate(tokens):
+            if token not in macrosyntax and token != u'#' and \
+                    rnd.random() < noise:
+                token = noisy(token, rnd)
+            lines.append(u'\t'.join([str(k + 1), token] + [u'_'] * 8))
+        lines.append(u'')
+    return lines
+
+
+# wrap a binary TextGrid file into a binary Praat Collection, after an
+# object of sound_bytes random bytes standing for a Sound
+def write_collection(tg_bin_path,
+                     collection_path,
+                     objname=u'sample',
+                     sound_bytes=0,
+                     seed=0):
+    payload = open(tg_bin_path, 'rb').read()
+    header = b'ooBinaryFile\x08TextGrid'
+    assert payload.startswith(header)
+    with open(collection_path, 'wb') as f:
+        f.write(b'ooBinaryFile\x0aCollection')
+        f.write(struct.pack('>i', 2 if sound_bytes else 1))
+        if sound_bytes:
+            rnd = random.Random(seed)
+            f.write(b'\x05Sound')
+            f.write(struct.pack('>h', len(objname)))
+            f.write(objname.encode('ascii'))
+            f.write(rnd.getrandbits(8 * sound_bytes).to_bytes(
+                sound_bytes, 'big'))
+        f.write(b'\x08TextGrid')
+        f.write(struct.pack('>h', len(objname)))
+        f.write(objname.encode('ascii'))
+        f.write(payload[len(header):])
+
+
+def write_textgrid(tg, path, fmt, sound_bytes=0):
+    if fmt == 'text':
+        tg.to_file(path, mode='normal', codec='utf-8')
+    elif fmt == 'short':
+        tg.to_file(path, mode='short', codec='utf-8')
+    elif fmt == 'binary':
+        tg.to_file(path, mode='binary')
+    elif fmt == 'collection':
+        tg.to_file(path + '.tmp', mode='binary')
+        write_collection(path + '.tmp', path, sound_bytes=sound_bytes)
+        os.remove(path + '.tmp')
+    else:
+        raise Exception('Unknown format {}'.format(fmt))
+
+
+# write the corpus in folder, return the paths of the CoNLL files and of the
+# TextGrid files by format
+def make_corpus(folder,
+                num_files=1,
+                num_sentences=100,
+                num_tiers=3,
+                pause_density=0.1,
+                noise=0.05,
+                reorder=0.0,
+                formats=formats,
+                sound_bytes=1000,
+                seed=0):
+    rnd = random.Random(seed)
+    paths = {}
+    for fmt in ['conll'] + list(formats):
+        paths[fmt] = []
+        if not os.path.exists(os.path.join(folder, fmt)):
+            os.makedirs(os.path.join(folder, fmt))
+    for k in range(num_files):
+        name = u'corpus_{:03d}'.format(k)
+        sents = make_sentences(num_sentences, pause_density, rnd)
+        conll_path = os.path.join(folder, 'conll', name + '.conll')
+        with open(conll_path, 'w', encoding='utf-8') as f:
+            f.write(u'\n'.join(make_conll(sents, noise, reorder, rnd)) + u'\n')
+        paths['conll'].append(conll_path)
+        tg = make_textgrid(sents, num_tiers, rnd)
+        for fmt in formats:
+            ext = '.Collection' if fmt == 'collection' else '.TextGrid'
+            path = os.path.join(folder, fmt, name + ext)
+            write_textgrid(tg, path, fmt, sound_bytes)
+            paths[fmt].append(path)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='synthetic corpus of paired CoNLL-U / TextGrid files')
+    parser.add_argument('folder', help='output folder')
+    parser.add_argument('--files', type=int, default=1, help='number of pairs')
+    parser.add_argument('--sentences',
+                        type=int,
+                        default=100,
+                        help='number of sentences by file')
+    parser.add_argument('--tiers',
+                        type=int,
+                        default=3,
+                        help='number of tiers of the TextGrids (at least 2)')
+    parser.add_argument('--pauses',
+                        type=float,
+                        default=0.1,
+                        help='probability of a pause after a token')
+    parser.add_argument('--noise',
+                        type=float,
+                        default=0.05,
+                        help='probability of a typo in a token of the CoNLL')
+    parser.add_argument('--reorder',
+                        type=float,
+                        default=0.0,
+                        help='probability of a sentence of the CoNLL to be '
+                        'swapped with the next one')
+    parser.add_argument('--formats',
+                        default=','.join(formats),
+                        help='formats of the TextGrids among {} (default: '
+                        'all)'.format(', '.join(formats)))
+    parser.add_argument('--sound-bytes',
+                        type=int,
+                        default=1000,
+                        help='size of the Sound of the Collections')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    paths = make_corpus(args.folder, args.files, args.sentences, args.tiers,
+                        args.pauses, args.noise, args.reorder,
+                        args.formats.split(','), args.sound_bytes, args.seed)
+    for fmt, fmt_paths in paths.items():
+        print('{} : {} file(s) in {}'.format(fmt, len(fmt_paths),
+                                            os.path.join(args.folder, fmt)))